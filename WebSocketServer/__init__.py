@@ -23,21 +23,28 @@
 # coding: utf-8
 
 from    .compat             import  compat_get_terminal_size, compat_kwargs
+from    .prefork            import  Supervisor
+from    .tlsconfig          import  TLSConfig, TLS_MINIMUM_VERSION, TLS_TICKET_ROTATION
 from    .utils              import  preferredencoding
 from    .websocketserver    import  *
 
 from    os.path     import  join
+from    .           import  optparser
 
-import  optparser
+import  os
 import  re
 import  signal
-import  ssl
 import  sys
 
+try:
+    from    .asyncwebsocketserver   import  AsyncWebSocketServer
+except (ImportError, SyntaxError):
+    AsyncWebSocketServer = None
+
 __version__ = '2018.04.25'
 
 def parse_opts(override=None):
-
+    
     def _format_option_string(option):
         opts = []
         
@@ -84,14 +91,45 @@ def parse_opts(override=None):
         action="store", dest="cert", help="cert (cert.pem)")
     parser.add_option("--pkey", default='', type='string',
         action="store", dest="pkey", help="pkey (privkey.pem)")
-    parser.add_option("--ver", default=ssl.PROTOCOL_TLSv1, type=int,
-        action="store", dest="ver", help="ssl version")
+    parser.add_option("--ver", default=TLS_MINIMUM_VERSION, type='choice',
+        choices=['1.2', '1.3'], action="store", dest="ver",
+        help="minimum TLS version (1.2, 1.3)")
+    parser.add_option("--no-tickets", default=True,
+        action="store_false", dest="tickets",
+        help="don't issue TLS session tickets")
+    parser.add_option("--ticket-rotation", default=None, type='int',
+        action="store", dest="ticket_rotation",
+        help="seconds between TLS session ticket key rotations, 0 to never rotate (%s, "
+            "never with --workers)" % TLS_TICKET_ROTATION)
     parser.add_option("--file", default='', type='string',
         action="store", dest="file",
         help="WebSocket Class File (e.g examplewebsockets)")
     parser.add_option("--socket", default='WebSocket', type='string',
         action="store", dest="socket",
         help="WebSocket Class (e.g SimpleEchoWebSocket, SimpleChatWebSocket)")
+    parser.add_option("--backlog", default=BACKLOG, type='int',
+        action="store", dest="backlog",
+        help="connections the kernel queues for us to accept (net.core.somaxconn, %s)" % BACKLOG)
+    parser.add_option("--workers", default=1, type='int',
+        action="store", dest="workers", help="worker processes (1)")
+    parser.add_option("--threads", default=0, type='int',
+        action="store", dest="threads",
+        help="run handlers on a pool of this many threads, 0 runs them in the server loop (0)")
+    parser.add_option("--max-inflight", default=MAX_INFLIGHT, type='int',
+        action="store", dest="maxinflight",
+        help="most handler calls queued on the thread pool at once (%s)" % MAX_INFLIGHT)
+    parser.add_option("--processes", default=0, type='int',
+        action="store", dest="processes",
+        help="run processhandlers on a pool of this many processes, 0 runs them in the server loop (0)")
+    parser.add_option("--metrics-path", default=None,
+        action="store", dest="metricspath",
+        help="answer a plain GET of this path (e.g. /metrics) with the server's metrics")
+    parser.add_option("--asyncio", default=False,
+        action="store_true", dest="asyncio",
+        help="serve with asyncio so handlers can be coroutines (python 3.5+)")
+    parser.add_option("--deflate", default=False,
+        action="store_true", dest="deflate",
+        help="offer permessage-deflate compression to clients")
     
     if override is not None:
         opts, args = parser.parse_args(override)
@@ -169,19 +207,74 @@ def main(argv=None):
             opts.cert = join(opts.ssldir, opts.cert)
             opts.pkey = join(opts.ssldir, opts.pkey)
         
+        #==========================================================
+        # Workers can't share new ticket keys, the ssl module has no
+        # way to set them, so with --workers they all keep the keys
+        # they were forked with rather than each rotating to its own
+        # and rejecting the others' tickets.
+        #==========================================================
+        rotation = opts.ticket_rotation
+        
+        if opts.workers > 1:
+            if rotation:
+                sys.stderr.write('error: option --ticket-rotation: not supported with --workers\n')
+                sys.exit(2)
+            
+            rotation = 0
+        elif rotation is None:
+            rotation = TLS_TICKET_ROTATION
+        
         try:
-            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            ssl_context.load_cert_chain(opts.cert, opts.pkey)
+            ssl_context = TLSConfig(opts.cert, opts.pkey, minimum_version=opts.ver,
+                tickets=opts.tickets, rotation=rotation)
         except Exception as ex:
             sys.stderr.write('%s\n' % str(ex))
             sys.exit(2)
     
-    server = WebSocketServer(('0.0.0.0' if opts.host == '' else opts.host),
-        opts.port, ssl_context, ':'.join([opts.file, opts.socket]))
+    if opts.asyncio:
+        if AsyncWebSocketServer is None:
+            sys.stderr.write('error: option --asyncio: requires python 3.5 or later\n')
+            sys.exit(2)
+        
+        if opts.threads > 0:
+            sys.stderr.write('error: option --threads: not supported with --asyncio\n')
+            sys.exit(2)
+        
+        server_class = AsyncWebSocketServer
+        kwargs = {'processes': opts.processes}
+    else:
+        server_class = WebSocketServer
+        kwargs = {'threads': opts.threads, 'maxinflight': opts.maxinflight,
+            'processes': opts.processes}
+    
+    kwargs['metricspath'] = opts.metricspath
+    
+    host = ('0.0.0.0' if opts.host == '' else opts.host)
+    websocketclass = ':'.join([opts.file, opts.socket])
+    
+    #==============================================================
+    # With more than one worker a supervisor forks the workers and
+    # each of them builds its own server.
+    #==============================================================
+    if opts.workers > 1:
+        if not hasattr(os, 'fork'):
+            sys.stderr.write('error: option --workers: requires os.fork\n')
+            sys.exit(2)
+        
+        def factory(**worker_kwargs):
+            worker_kwargs.update(kwargs)
+            return server_class(host, opts.port, ssl_context, websocketclass,
+                deflate=opts.deflate, backlog=opts.backlog, **worker_kwargs)
+        
+        Supervisor(host, opts.port, opts.workers, factory, backlog=opts.backlog).run()
+        sys.exit()
+    
+    server = server_class(host, opts.port, ssl_context, websocketclass, deflate=opts.deflate,
+        backlog=opts.backlog, **kwargs)
     
     def close_sig_handler(signal, frame):
         server.close()
         sys.exit()
     
     signal.signal(signal.SIGINT, close_sig_handler)
-    server.run()
+    server.run()
\ No newline at end of file
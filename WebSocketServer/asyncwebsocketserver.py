@@ -0,0 +1,406 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# Requires Python 3.5+, WebSocketServer only
+# imports this module when asyncio is available.
+#===================================================
+
+from    .permessagedeflate  import  DeflateCache
+from    .timerwheel         import  monotonic
+from    .websocket          import  *
+from    .websocket          import  _check_unicode
+from    .websocketserver    import  BACKLOG, CHECK_INTERVAL, TLS_HANDSHAKE_TIMEOUT
+from    .websocketserver    import  _BaseWebSocketServer, _listen, _load_websocketclass
+from    collections         import  deque
+
+import  asyncio
+import  errno
+import  inspect
+import  socket
+import  struct
+import  sys
+
+class _StreamSocket(object):
+    #======================================================================
+    # Gives WebSocket the parts of the socket interface it uses on top of
+    # an asyncio stream so frame encoding and close() work unchanged.
+    #======================================================================
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.transport = writer.transport
+        self.sock = writer.get_extra_info('socket')
+    
+    def abort(self):
+        #==================================================================
+        # Reset the connection, dropping whatever the transport and the
+        # kernel still have to send.
+        #==================================================================
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.transport.abort()
+    
+    def close(self):
+        self.writer.close()
+    
+    def fileno(self):
+        return self.sock.fileno()
+    
+    def send(self, data):
+        #==================================================================
+        # Refuse to buffer more once the transport has paused writing, the
+        # rest stays in the sendq where it counts towards the watermarks.
+        #==================================================================
+        if self.transport.is_closing():
+            raise socket.error(errno.EPIPE, 'error: stream closed')
+        
+        if self.transport.get_write_buffer_size() > self.transport.get_write_buffer_limits()[1]:
+            raise socket.error(errno.EAGAIN, 'info: stream buffer full')
+        
+        self.writer.write(data)
+        return len(data)
+
+class AsyncWebSocketServer(_BaseWebSocketServer):
+    def __init__(self, host, port, ssl_context=None, websocketclass=WebSocket,
+            reuse_port=False, master=None, bus=None, deflate=False, backlog=BACKLOG,
+            processes=0, metricspath=None):
+        try:
+            if master is None:
+                master = _listen(host, port, reuse_port, backlog)
+            
+            self.master = master
+            sys.stdout.write('Server started\nListening on: %s:%s\nMaster socket: Resource #%s\n'
+                % (host, port, self.master.fileno()))
+        except Exception as ex:
+            sys.stderr.write('%s\n' % str(ex))
+            sys.exit(2)
+        
+        self._set_ssl_context(ssl_context)
+        self.deflate = deflate
+        self.deflatecache = DeflateCache()
+        self.socks = {}
+        self.topics = {}
+        self.flushing = set()
+        self.draining = set()
+        self.running = set()
+        
+        #==================================================================
+        # Throttled clients map to a future that _serve() waits on before
+        # reading again.
+        #==================================================================
+        self.throttled = {}
+        self.loop = None
+        self.server = None
+        self.bus = bus
+        self.backlog = backlog
+        self.processpool = self._process_pool(processes)
+        self._init_metrics(metricspath)
+        
+        self.websocketclass = _load_websocketclass(websocketclass)
+    
+    def _bus_close(self):
+        self.loop.remove_reader(self.bus.fileno())
+        self.loop.remove_writer(self.bus.fileno())
+        self.bus.close()
+        self.bus = None
+    
+    def _bus_want_write(self, want):
+        if self.loop is None:
+            return
+        
+        if want:
+            self.loop.add_writer(self.bus.fileno(), self._bus_write)
+        else:
+            self.loop.remove_writer(self.bus.fileno())
+    
+    def _check_throttled(self, websocket, resume):
+        #==================================================================
+        # Runs every CHECK_INTERVAL seconds for as long as this particular
+        # spell of throttling lasts.
+        #==================================================================
+        if self.throttled.get(websocket) is not resume:
+            return
+        
+        websocket._check_slow_consumer()
+        
+        if self.throttled.get(websocket) is resume:
+            self.loop.call_later(CHECK_INTERVAL, self._check_throttled, websocket, resume)
+    
+    def _construct_websocket(self, sock, address):
+        return self.websocketclass(self, sock, address)
+    
+    def _discard(self, websocket):
+        fileno = websocket.fileno
+        
+        if self.socks.get(fileno) is websocket:
+            del self.socks[fileno]
+        
+        resume = self.throttled.pop(websocket, None)
+        
+        if resume is not None and not resume.done():
+            resume.set_result(None)
+        
+        self._unsubscribe_all(websocket)
+    
+    async def _drain(self, websocket):
+        #==================================================================
+        # Wait for the transport to take more and flush again.
+        #==================================================================
+        try:
+            await websocket.sock.writer.drain()
+        except Exception as ex:
+            sys.stderr.write('%s\n' % str(ex))
+        finally:
+            self.draining.discard(websocket)
+        
+        #==================================================================
+        # A closing websocket still has its close frame to send.
+        #==================================================================
+        if websocket.closed is False or websocket.closetimer is not None:
+            self._flush(websocket)
+    
+    def _flush(self, websocket):
+        #==================================================================
+        # Move the sendq onto the stream. Whatever the transport won't
+        # take yet is written when it has drained.
+        #==================================================================
+        self.flushing.discard(websocket)
+        
+        try:
+            websocket._send_queue()
+        except Exception as ex:
+            sys.stderr.write('%s\n' % str(ex))
+            websocket.close()
+            return
+        
+        if websocket.sendq and websocket not in self.draining:
+            self.draining.add(websocket)
+            self.loop.create_task(self._drain(websocket))
+    
+    async def _awaited(self, result, start):
+        try:
+            return await result
+        finally:
+            self.metrics.handler.observe(monotonic() - start)
+    
+    def _handled(self, result, start):
+        #==================================================================
+        # A coroutine handle_message is timed until it finishes.
+        #==================================================================
+        if inspect.isawaitable(result):
+            return self._awaited(result, start)
+        
+        return _BaseWebSocketServer._handled(self, result, start)
+    
+    def _process(self, websocket, data):
+        #==================================================================
+        # Not awaited, so the connection's next message can go to another
+        # worker while this one runs. Replies are sent in order.
+        #==================================================================
+        if self.processpool is None:
+            return _BaseWebSocketServer._process(self, websocket, data)
+        
+        future = self.processpool.submit(websocket.processhandler, data, _check_unicode(data))
+        websocket.replies.append(future)
+        future.add_done_callback(lambda future: self.loop.call_soon_threadsafe(self._replies, websocket))
+    
+    async def _rotate(self):
+        #==================================================================
+        # asyncio fixes the context when it starts serving, so start a new
+        # server with the new one and stop the old from accepting. The
+        # connections it already has carry on.
+        #==================================================================
+        self.tls.rotate()
+        self.ssl_context = self.tls.context
+        
+        server = self.server
+        self.server = await self._start_server()
+        server.close()
+        
+        self._schedule_rotation()
+    
+    async def _run_handlers(self, websocket):
+        #==================================================================
+        # Handlers for a connection run one at a time in the order they
+        # were queued, a coroutine is awaited before the next one starts.
+        # Other connections carry on while it waits.
+        #==================================================================
+        if websocket in self.running:
+            return
+        
+        inbox = websocket.inbox
+        self.running.add(websocket)
+        
+        try:
+            while inbox:
+                handler, websocket.opcode, websocket.data = inbox.popleft()
+                
+                try:
+                    result = handler()
+                    
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as ex:
+                    sys.stderr.write('%s\n' % str(ex))
+                    
+                    if websocket.closed is False:
+                        websocket.close()
+        finally:
+            self.running.discard(websocket)
+    
+    async def _serve(self, reader, writer):
+        sock = _StreamSocket(reader, writer)
+        websocket = self._construct_websocket(sock, writer.get_extra_info('peername'))
+        websocket.inbox = deque()
+        
+        self.socks[websocket.fileno] = websocket
+        sys.stdout.write('Client connected. Resource #%s\n' % websocket.fileno)
+        websocket._accepted()
+        self.metrics.connections.value += 1
+        
+        if self.tls is not None:
+            self.tls.handshaked(writer.get_extra_info('ssl_object'))
+        
+        try:
+            while websocket.closed is False:
+                resume = self.throttled.get(websocket)
+                
+                if resume is not None:
+                    await resume
+                    continue
+                
+                if websocket.handshaked is False:
+                    data = await reader.read(websocket.headertoread)
+                    
+                    if not data:
+                        raise Exception('info: remote socket closed')
+                    
+                    websocket._do_handshake(data)
+                else:
+                    data = await reader.read(16384)
+                    
+                    if not data:
+                        raise Exception('info: remote socket closed')
+                    
+                    websocket._parse_message(data)
+                
+                await self._run_handlers(websocket)
+        except Exception as ex:
+            sys.stderr.write('%s\n' % str(ex))
+        finally:
+            if websocket.closed is False:
+                websocket.close()
+            
+            await self._run_handlers(websocket)
+    
+    def _schedule(self, delay, func, *args):
+        return self.loop.call_later(delay, func, *args)
+    
+    def _schedule_rotation(self):
+        due = self.tls.due()
+        
+        if due is not None:
+            self.loop.call_later(due, lambda: self.loop.create_task(self._rotate()))
+    
+    def _start_server(self):
+        kwargs = {}
+        
+        #==================================================================
+        # asyncio does the TLS handshake without blocking the loop, from
+        # 3.7 it can also time it out.
+        #==================================================================
+        if self.ssl_context is not None and sys.version_info >= (3, 7):
+            kwargs['ssl_handshake_timeout'] = TLS_HANDSHAKE_TIMEOUT
+        
+        #==================================================================
+        # Each server gets its own copy of the listening socket as closing
+        # the server closes it, see _rotate(). asyncio calls listen() on it
+        # again and accepts up to backlog connections at a time.
+        #==================================================================
+        return asyncio.start_server(self._serve, sock=self.master.dup(),
+            ssl=self.ssl_context, limit=MAXHEADER, backlog=self.backlog, **kwargs)
+    
+    def _throttle(self, websocket, throttled):
+        #==================================================================
+        # Stop reading from a client while its sendq is over the high
+        # watermark. Handlers queued while it was throttled, such as
+        # handle_drain(), are run once it resumes.
+        #==================================================================
+        if self.socks.get(websocket.fileno) is not websocket:
+            return
+        
+        if throttled:
+            resume = self.throttled[websocket] = self.loop.create_future()
+            self.loop.call_later(CHECK_INTERVAL, self._check_throttled, websocket, resume)
+        else:
+            resume = self.throttled.pop(websocket, None)
+            
+            if resume is not None and not resume.done():
+                resume.set_result(None)
+            
+            self.loop.create_task(self._run_handlers(websocket))
+    
+    def _want_write(self, websocket):
+        #==================================================================
+        # Coalesce everything queued during this pass of the loop into
+        # one flush.
+        #==================================================================
+        if websocket not in self.flushing and self.loop is not None:
+            self.flushing.add(websocket)
+            self.loop.call_soon(self._flush, websocket)
+    
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        
+        if self.processpool is not None:
+            self.processpool.shutdown()
+        
+        self.master.close()
+        
+        for sock in list(self.socks.values()):
+            sock.close()
+        
+        if self.loop is not None:
+            self.loop.stop()
+    
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        
+        self.server = self.loop.run_until_complete(self._start_server())
+        
+        if self.tls is not None:
+            self._schedule_rotation()
+        
+        if self.bus is not None:
+            self.loop.add_reader(self.bus.fileno(), self._bus_read)
+            
+            if self.bus.outbound:
+                self._bus_want_write(True)
+        
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
\ No newline at end of file
@@ -0,0 +1,257 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# Fan-out of broadcast frames between the worker
+# processes started by --workers.
+#
+# Every worker has a Unix socket to the supervisor,
+# which relays each message it gets from one worker
+# to all the others. Messages carry the websocket
+# frame exactly as it will be sent, so it is only
+# encoded once by the worker that broadcast it.
+#===================================================
+
+from    .poller     import  DefaultPoller, READ, WRITE
+from    collections import  deque
+
+import  errno
+import  socket
+import  struct
+import  sys
+
+#==========================================================================
+# Message kinds, which decide the connections a frame is delivered to.
+#==========================================================================
+ALL             = 0x00
+TOPIC           = 0x01
+
+#==========================================================================
+# Each message is a header (kind, channel length, frame length) followed
+# by the channel name and the frame.
+#==========================================================================
+HEADER          = struct.Struct('!BHI')
+
+#==========================================================================
+# Stop queueing to a peer that has this much outstanding, it isn't
+# reading and we don't want the backlog to take the process down.
+#==========================================================================
+MAXBACKLOG      = 67108864
+
+def _encode(kind, channel, frame):
+    channel = channel.encode('utf-8')
+    return HEADER.pack(kind, len(channel), len(frame)) + channel, frame
+
+def _decode(message):
+    kind, channel_length, frame_length = HEADER.unpack_from(message)
+    offset = HEADER.size + channel_length
+    channel = bytes(message[HEADER.size:offset]).decode('utf-8')
+    
+    return kind, channel, bytes(message[offset:offset + frame_length])
+
+class _Link(object):
+    #======================================================================
+    # One end of a Unix stream socket carrying length prefixed messages.
+    #======================================================================
+    def __init__(self, sock):
+        sock.setblocking(0)
+        
+        self.sock = sock
+        self.inbound = bytearray()
+        self.outbound = deque()
+        self.offset = 0
+        self.backlog = 0
+    
+    def close(self):
+        self.sock.close()
+    
+    def fileno(self):
+        return self.sock.fileno()
+    
+    def queue(self, buffers):
+        #==================================================================
+        # Returns True when the link needs write interest, i.e. it had
+        # nothing outstanding before this call.
+        #==================================================================
+        size = sum(len(buffer) for buffer in buffers)
+        
+        if self.backlog + size > MAXBACKLOG:
+            sys.stderr.write('error: broadcast link backlog full, message dropped\n')
+            return False
+        
+        empty = not self.outbound
+        
+        self.outbound.extend(buffers)
+        self.backlog += size
+        
+        return empty
+    
+    def read(self):
+        #==================================================================
+        # Returns the complete messages received so far, raises when the
+        # other end has gone away.
+        #==================================================================
+        try:
+            data = self.sock.recv(262144)
+        except socket.error as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return []
+            
+            raise
+        
+        if not data:
+            raise Exception('info: broadcast link closed')
+        
+        self.inbound.extend(data)
+        
+        messages = []
+        inbound = self.inbound
+        offset = 0
+        
+        while len(inbound) - offset >= HEADER.size:
+            kind, channel_length, frame_length = HEADER.unpack_from(inbound, offset)
+            end = offset + HEADER.size + channel_length + frame_length
+            
+            if end > len(inbound):
+                break
+            
+            messages.append(bytes(inbound[offset:end]))
+            offset = end
+        
+        if offset > 0:
+            del inbound[:offset]
+        
+        return messages
+    
+    def write(self):
+        #==================================================================
+        # Returns True once everything queued has been written.
+        #==================================================================
+        outbound = self.outbound
+        
+        while outbound:
+            buffer = outbound[0]
+            
+            try:
+                sent = self.sock.send(memoryview(buffer)[self.offset:])
+            except socket.error as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return False
+                
+                raise
+            
+            self.offset += sent
+            self.backlog -= sent
+            
+            if self.offset == len(buffer):
+                outbound.popleft()
+                self.offset = 0
+        
+        return True
+
+class BroadcastBus(_Link):
+    #======================================================================
+    # The worker end of a link, the server registers fileno() with its
+    # poller and calls receive()/write() when it is ready.
+    #======================================================================
+    def publish(self, kind, channel, frame):
+        return self.queue(_encode(kind, channel, frame))
+    
+    def receive(self):
+        return [_decode(message) for message in self.read()]
+
+class BroadcastHub(object):
+    #======================================================================
+    # The supervisor end. Holds a link per worker slot and relays every
+    # message unchanged to all the other links.
+    #======================================================================
+    def __init__(self):
+        self.poller = DefaultPoller()
+        self.links = {}
+        self.slots = {}
+    
+    def _drop(self, link):
+        fileno = link.fileno()
+        
+        self.poller.unregister(fileno)
+        del self.links[fileno]
+        
+        for slot, other in list(self.slots.items()):
+            if other is link:
+                del self.slots[slot]
+        
+        link.close()
+    
+    def close(self):
+        #==================================================================
+        # Only close our descriptors, this is also called in a forked
+        # worker and must not change the supervisor's registrations.
+        #==================================================================
+        for link in self.links.values():
+            link.close()
+        
+        self.links = {}
+        self.slots = {}
+        self.poller.close()
+    
+    def connect(self, slot):
+        #==================================================================
+        # Create the link for a worker slot, replacing any previous one,
+        # and return the socket the worker should use.
+        #==================================================================
+        if slot in self.slots:
+            self._drop(self.slots[slot])
+        
+        hub_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        link = _Link(hub_end)
+        
+        self.links[link.fileno()] = link
+        self.slots[slot] = link
+        self.poller.register(link.fileno(), READ)
+        
+        return worker_end
+    
+    def poll(self, timeout=None):
+        for fileno, events in self.poller.poll(timeout):
+            link = self.links.get(fileno)
+            
+            if link is None:
+                continue
+            
+            try:
+                if events & WRITE:
+                    if link.write():
+                        self.poller.modify(fileno, READ)
+                
+                if events & READ:
+                    for message in link.read():
+                        self._relay(link, message)
+            except Exception as ex:
+                sys.stderr.write('%s\n' % str(ex))
+                self._drop(link)
+    
+    def _relay(self, source, message):
+        for fileno, link in self.links.items():
+            if link is not source and link.queue((message,)):
+                self.poller.modify(fileno, READ | WRITE)
\ No newline at end of file
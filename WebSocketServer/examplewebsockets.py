@@ -35,24 +35,20 @@ class SimpleEchoWebSocket(WebSocket):
         self.send_message(self.data)
         print (self.data)
 
-clients = []
-
 class SimpleChatWebSocket(WebSocket):
+    #======================================================================
+    # broadcast() reaches clients in every worker process, so this works
+    # the same with --workers.
+    #======================================================================
     def handle_close(self):
-        clients.remove(self)
         print ('Client %s closed.' % str(self.address))
         
-        for client in clients:
-            client.send_message(u'%s - disconnected' % self.address[0])
+        self.master.broadcast(u'%s - disconnected' % self.address[0])
     
     def handle_connected(self):
-        clients.append(self)
         print ('Client %s connected.' % str(self.address))
         
-        for client in clients:
-            client.send_message(u'%s - connected' % self.address[0])
+        self.master.broadcast(u'%s - connected' % self.address[0])
     
     def handle_message(self):
-        for client in clients:
-            if client != self:
-                client.send_message(u'%s - %s' % (self.address[0], self.data))
\ No newline at end of file
+        self.master.broadcast(u'%s - %s' % (self.address[0], self.data), exclude=self)
\ No newline at end of file
@@ -0,0 +1,134 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# Parser for the HTTP upgrade request that opens a
+# WebSocket connection.
+#
+# It only understands what RFC 6455 allows, a GET
+# request of HTTP/1.1 or later, and only keeps the
+# headers the handshake looks at.
+#===================================================
+
+import  re
+
+#==========================================================================
+# The headers kept by parse_request(), in lower case.
+#==========================================================================
+HEADERS = frozenset([
+    b'host',
+    b'upgrade',
+    b'connection',
+    b'origin',
+    b'sec-websocket-key',
+    b'sec-websocket-version',
+    b'sec-websocket-protocol',
+    b'sec-websocket-extensions',
+])
+
+TERMINATOR = b'\r\n\r\n'
+
+BAD_REQUEST         = 'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n'
+METHOD_NOT_ALLOWED  = 'HTTP/1.1 405 Method Not Allowed\r\nAllow: GET\r\nConnection: close\r\n\r\n'
+UPGRADE_REQUIRED    = ('HTTP/1.1 426 Upgrade Required\r\nSec-WebSocket-Version: 13\r\n'
+    'Connection: close\r\n\r\n')
+
+_REQUEST_LINE = re.compile(br'([A-Z]+) (\S+) HTTP/(\d+)\.(\d+)$')
+
+class Headers(dict):
+    #======================================================================
+    # Header values by lower case name. A header sent more than once has
+    # its values joined with commas, as HTTP allows for the ones we use.
+    #======================================================================
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+    
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+    
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+def find_terminator(buffer, scanned):
+    #======================================================================
+    # Where the request head ends in buffer, or -1. scanned is how much of
+    # buffer was searched last time, only the new bytes and the three
+    # before them (which may hold part of the terminator) are searched.
+    #======================================================================
+    return buffer.find(TERMINATOR, max(0, scanned - 3))
+
+def parse_request(head):
+    #======================================================================
+    # head is the request up to, but not including, the blank line.
+    # Returns (method, resource, headers), or None if it isn't a valid
+    # HTTP/1.1 request.
+    #======================================================================
+    lines = bytes(head).split(b'\r\n')
+    match = _REQUEST_LINE.match(lines[0])
+    
+    if match is None:
+        return None
+    
+    method, resource, major, minor = match.groups()
+    
+    if (int(major), int(minor)) < (1, 1):
+        return None
+    
+    headers = Headers()
+    
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        
+        #==================================================================
+        # No folded lines and no space before the colon (RFC 7230 3.2.4).
+        #==================================================================
+        if not sep or not name or name != name.strip():
+            return None
+        
+        name = name.lower()
+        
+        if name not in HEADERS:
+            continue
+        
+        name = name.decode('ascii')
+        value = value.strip().decode('latin-1')
+        
+        if name in headers:
+            value = headers[name] + ', ' + value
+        
+        headers[name] = value
+    
+    return method.decode('ascii'), resource.decode('latin-1'), headers
+
+def has_token(value, token):
+    #======================================================================
+    # True if the comma separated header value holds token, ignoring case.
+    #======================================================================
+    token = token.lower()
+    
+    for item in value.split(','):
+        if item.strip().lower() == token:
+            return True
+    
+    return False
\ No newline at end of file
@@ -0,0 +1,94 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# Fixed bucket histogram. A value is counted in the
+# first bucket whose upper bound it doesn't exceed,
+# anything above the last bound goes in an overflow
+# bucket, so observe() is one bisect and two adds.
+#===================================================
+
+from    bisect      import  bisect_left
+
+#==========================================================================
+# Upper bounds in seconds for round trip times.
+#==========================================================================
+RTT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#==========================================================================
+# Upper bounds in seconds for the time taken by handlers and the like.
+#==========================================================================
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0)
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+    
+    def quantile(self, q):
+        #==================================================================
+        # The upper bound of the bucket holding the q quantile (0 to 1),
+        # None with nothing observed and inf if it's in the overflow.
+        #==================================================================
+        if self.count == 0:
+            return None
+        
+        rank = q * self.count
+        seen = 0
+        
+        for index, count in enumerate(self.counts):
+            seen += count
+            
+            if count and seen >= rank:
+                break
+        
+        if index < len(self.buckets):
+            return self.buckets[index]
+        
+        return float('inf')
+    
+    def stats(self):
+        #==================================================================
+        # Cumulative counts by upper bound as Prometheus has them.
+        #==================================================================
+        cumulative = []
+        seen = 0
+        
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            cumulative.append((bound, seen))
+        
+        return {
+            'buckets': cumulative,
+            'count': self.count,
+            'sum': self.sum,
+        }
\ No newline at end of file
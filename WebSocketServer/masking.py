@@ -0,0 +1,121 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+import  binascii
+
+try:
+    import  numpy
+except ImportError:
+    numpy = None
+
+#==========================================================================
+# Payloads shorter than this are not worth the cost of building numpy
+# arrays, the wide integer path is faster for them.
+#==========================================================================
+NUMPY_THRESHOLD = 4096
+
+def _rotate(mask, offset):
+    offset %= 4
+    
+    if offset:
+        return mask[offset:] + mask[:offset]
+    
+    return mask
+
+def unmask_bytes(data, mask, offset=0):
+    #======================================================================
+    # XOR data with a 4 byte mask one byte at a time. This is the
+    # reference implementation, the other routines must produce the same
+    # output.
+    #======================================================================
+    data = bytearray(data)
+    mask = bytearray(mask)
+    
+    for i in range(len(data)):
+        data[i] ^= mask[(offset + i) % 4]
+    
+    return data
+
+if hasattr(int, 'from_bytes'):
+    def unmask_int(data, mask, offset=0):
+        #==================================================================
+        # XOR data with a 4 byte mask as a single wide integer. The mask
+        # is repeated to the length of data so the whole payload is done
+        # with one int operation.
+        #==================================================================
+        length = len(data)
+        
+        if length == 0:
+            return bytearray()
+        
+        mask = _rotate(bytes(mask), offset)
+        mask = (mask * (length // 4 + 1))[:length]
+        value = int.from_bytes(data, 'little') ^ int.from_bytes(mask, 'little')
+        
+        return bytearray(value.to_bytes(length, 'little'))
+else:
+    def unmask_int(data, mask, offset=0):
+        #==================================================================
+        # XOR data with a 4 byte mask as a single wide integer. The mask
+        # is repeated to the length of data so the whole payload is done
+        # with one int operation.
+        #==================================================================
+        length = len(data)
+        
+        if length == 0:
+            return bytearray()
+        
+        mask = str(_rotate(bytearray(mask), offset))
+        mask = (mask * (length // 4 + 1))[:length]
+        value = int(binascii.hexlify(bytes(data)), 16) ^ int(binascii.hexlify(mask), 16)
+        
+        return bytearray(binascii.unhexlify('%0*x' % (length * 2, value)))
+
+if numpy is not None:
+    def unmask_numpy(data, mask, offset=0):
+        #==================================================================
+        # XOR data with a 4 byte mask using numpy arrays.
+        #==================================================================
+        length = len(data)
+        
+        if length == 0:
+            return bytearray()
+        
+        mask = numpy.frombuffer(_rotate(bytes(mask), offset), dtype=numpy.uint8)
+        data = numpy.frombuffer(data, dtype=numpy.uint8)
+        
+        return bytearray(numpy.bitwise_xor(data, numpy.resize(mask, length)).tobytes())
+else:
+    unmask_numpy = None
+
+def unmask(data, mask, offset=0):
+    #======================================================================
+    # Unmask a payload slice. offset is the position of data within the
+    # frame payload so a frame that arrives over several recvs can be
+    # unmasked a slice at a time. Returns a bytearray.
+    #======================================================================
+    if unmask_numpy is not None and len(data) >= NUMPY_THRESHOLD:
+        return unmask_numpy(data, mask, offset)
+    
+    return unmask_int(data, mask, offset)
\ No newline at end of file
@@ -0,0 +1,150 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# Server metrics in the Prometheus text format.
+#
+# Updating them has to be cheap as it happens for
+# every frame, so counters are plain attributes and
+# lists that the server and its WebSockets add to
+# directly, and gauges are functions only called
+# when the metrics are rendered.
+#===================================================
+
+from    .histogram  import  DURATION_BUCKETS, Histogram
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#==========================================================================
+# Label values for the per opcode counts, reserved opcodes aren't shown.
+#==========================================================================
+OPCODES = {
+    0x0: 'continuation',
+    0x1: 'text',
+    0x2: 'binary',
+    0x8: 'close',
+    0x9: 'ping',
+    0xA: 'pong',
+}
+
+class Counter(object):
+    __slots__ = ('value',)
+    
+    def __init__(self):
+        self.value = 0
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+    
+    def _samples(self, name, source):
+        if isinstance(source, Counter):
+            return ['%s %s' % (name, source.value)]
+        
+        if isinstance(source, Histogram):
+            stats = source.stats()
+            samples = []
+            
+            for bound, count in stats['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append('%s_bucket{le="%s"} %s' % (name, le, count))
+            
+            samples.append('%s_sum %r' % (name, stats['sum']))
+            samples.append('%s_count %s' % (name, stats['count']))
+            
+            return samples
+        
+        if isinstance(source, list):
+            return ['%s{opcode="%s"} %s' % (name, OPCODES[opcode], source[opcode])
+                for opcode in sorted(OPCODES)]
+        
+        #==================================================================
+        # A function, which returns None when it has nothing to report.
+        #==================================================================
+        value = source()
+        
+        if value is None:
+            return []
+        
+        return ['%s %r' % (name, value)]
+    
+    def add(self, name, kind, help, source):
+        #==================================================================
+        # source is a Counter, a Histogram, a list of counts by opcode or
+        # a function returning the value.
+        #==================================================================
+        self.metrics.append((name, kind, help, source))
+        
+        return source
+    
+    def render(self):
+        lines = []
+        
+        for name, kind, help, source in self.metrics:
+            samples = self._samples(name, source)
+            
+            if not samples:
+                continue
+            
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(samples)
+        
+        return '\n'.join(lines) + '\n'
+    
+    def response(self):
+        #==================================================================
+        # The metrics as a complete HTTP response.
+        #==================================================================
+        body = self.render().encode('utf-8')
+        head = ('HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %s\r\n'
+            'Connection: close\r\n\r\n' % (CONTENT_TYPE, len(body)))
+        
+        return head.encode('ascii') + body
+
+class Metrics(Registry):
+    #======================================================================
+    # What the servers and their WebSockets count. Frames and bytes are
+    # counted by opcode as they are parsed or queued, bytes include the
+    # frame headers.
+    #======================================================================
+    def __init__(self):
+        Registry.__init__(self)
+        
+        self.connections = self.add('websocket_connections_total', 'counter',
+            'Connections accepted.', Counter())
+        self.handshakes = self.add('websocket_handshakes_total', 'counter',
+            'WebSocket upgrades completed.', Counter())
+        self.rejected = self.add('websocket_handshakes_rejected_total', 'counter',
+            'Upgrade requests answered with an HTTP error.', Counter())
+        self.framesin = self.add('websocket_frames_received_total', 'counter',
+            'Frames received by opcode.', [0] * 16)
+        self.bytesin = self.add('websocket_received_bytes_total', 'counter',
+            'Bytes of frames received by opcode.', [0] * 16)
+        self.framesout = self.add('websocket_frames_sent_total', 'counter',
+            'Frames queued to send by opcode.', [0] * 16)
+        self.bytesout = self.add('websocket_sent_bytes_total', 'counter',
+            'Bytes of frames queued to send by opcode.', [0] * 16)
+        self.handler = self.add('websocket_handle_message_seconds', 'histogram',
+            'Time spent in handle_message.', Histogram(DURATION_BUCKETS))
\ No newline at end of file
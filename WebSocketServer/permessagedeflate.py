@@ -0,0 +1,343 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# The permessage-deflate extension (RFC 7692).
+#
+# negotiate() picks the first acceptable offer from
+# the client's Sec-WebSocket-Extensions headers and
+# returns a PerMessageDeflate holding the zlib
+# state for that connection.
+#===================================================
+
+from    collections import  OrderedDict
+
+import  zlib
+
+EXTENSION_NAME  = 'permessage-deflate'
+
+#==========================================================================
+# Messages shorter than this many bytes are sent uncompressed, deflate
+# doesn't gain anything on them and costs CPU.
+#==========================================================================
+DEFLATE_THRESHOLD   = 1024
+
+#==========================================================================
+# The most memory the zlib state of one connection may use. If the
+# negotiated window sizes would need more, the window and memLevel are
+# lowered until they fit, or the offer is declined.
+#==========================================================================
+DEFLATE_MAXMEMORY   = 327680
+
+#==========================================================================
+# Our preferences, the client's offer can only make these smaller. With
+# DEFLATE_NO_CONTEXT_TAKEOVER every message we send is compressed on its
+# own, which compresses less but lets broadcasts share compressed frames.
+#==========================================================================
+DEFLATE_LEVEL               = 6
+DEFLATE_MEMLEVEL            = 8
+DEFLATE_WINDOW_BITS         = 15
+DEFLATE_NO_CONTEXT_TAKEOVER = False
+
+#==========================================================================
+# Limits on the cache of compressed messages shared between connections,
+# in entries and in bytes of message plus compressed frame.
+#==========================================================================
+DEFLATE_CACHE_SIZE  = 256
+DEFLATE_CACHE_BYTES = 16777216
+
+#==========================================================================
+# Every flushed deflate block ends with this, it is left off the wire.
+#==========================================================================
+_TAIL = b'\x00\x00\xff\xff'
+
+def _memory(server_bits, client_bits, memlevel):
+    #======================================================================
+    # zlib's own estimates (zconf.h) for a compressor and a decompressor.
+    #======================================================================
+    return (1 << (server_bits + 2)) + (1 << (memlevel + 9)) + (1 << client_bits)
+
+def _window_bits(value):
+    try:
+        bits = int(value)
+    except (TypeError, ValueError):
+        return None
+    
+    if bits < 8 or bits > 15 or str(bits) != value:
+        return None
+    
+    return bits
+
+def parse_extensions(values):
+    #======================================================================
+    # Split Sec-WebSocket-Extensions header values into a list of
+    # (name, [(param, value or None), ...]) in the order they were offered.
+    #======================================================================
+    offers = []
+    
+    for value in values:
+        for extension in value.split(','):
+            parts = [part.strip() for part in extension.split(';')]
+            
+            if not parts[0]:
+                continue
+            
+            params = []
+            
+            for part in parts[1:]:
+                if not part:
+                    continue
+                
+                name, sep, param = part.partition('=')
+                params.append((name.strip().lower(), param.strip().strip('"') if sep else None))
+            
+            offers.append((parts[0].lower(), params))
+    
+    return offers
+
+def _accept(params, window_bits, no_context_takeover, maxmemory):
+    server_no_context_takeover = no_context_takeover
+    client_no_context_takeover = False
+    server_bits = window_bits
+    client_bits = 15
+    client_bits_offered = False
+    seen = set()
+    
+    for name, value in params:
+        #==================================================================
+        # A repeated or unknown parameter, or a bad value, means we must
+        # decline this offer.
+        #==================================================================
+        if name in seen:
+            return None
+        
+        seen.add(name)
+        
+        if name == 'server_no_context_takeover':
+            if value is not None:
+                return None
+            
+            server_no_context_takeover = True
+        elif name == 'client_no_context_takeover':
+            if value is not None:
+                return None
+            
+            client_no_context_takeover = True
+        elif name == 'server_max_window_bits':
+            bits = _window_bits(value)
+            
+            #==============================================================
+            # zlib can't compress with a 256 byte window.
+            #==============================================================
+            if bits is None or bits == 8:
+                return None
+            
+            server_bits = min(server_bits, bits)
+        elif name == 'client_max_window_bits':
+            client_bits_offered = True
+            
+            if value is not None:
+                bits = _window_bits(value)
+                
+                if bits is None:
+                    return None
+                
+                client_bits = bits
+            
+            client_bits = min(client_bits, window_bits)
+        else:
+            return None
+    
+    memlevel = DEFLATE_MEMLEVEL
+    
+    while _memory(server_bits, max(client_bits, 9), memlevel) > maxmemory:
+        if server_bits > 9:
+            server_bits -= 1
+        elif client_bits_offered and client_bits > 9:
+            client_bits -= 1
+        elif memlevel > 1:
+            memlevel -= 1
+        else:
+            return None
+    
+    #======================================================================
+    # Only tell the client to limit its window when it offered to and the
+    # limit is below the default.
+    #======================================================================
+    if client_bits_offered is False or client_bits == 15:
+        client_bits = None
+    
+    return PerMessageDeflate(server_no_context_takeover, client_no_context_takeover,
+        server_bits, client_bits, memlevel)
+
+def negotiate(values, window_bits=DEFLATE_WINDOW_BITS, no_context_takeover=DEFLATE_NO_CONTEXT_TAKEOVER,
+        maxmemory=DEFLATE_MAXMEMORY):
+    #======================================================================
+    # values are the client's Sec-WebSocket-Extensions headers. Returns a
+    # PerMessageDeflate for the first offer we can accept or None.
+    #======================================================================
+    for name, params in parse_extensions(values):
+        if name != EXTENSION_NAME:
+            continue
+        
+        deflate = _accept(params, window_bits, no_context_takeover, maxmemory)
+        
+        if deflate is not None:
+            return deflate
+    
+    return None
+
+class DeflateCache(object):
+    #======================================================================
+    # A small LRU of compressed frames. Without context takeover the
+    # compressed bytes of a message only depend on the message and the
+    # compression parameters, so one copy serves every connection that
+    # negotiated the same ones. Keys pair something identifying the message
+    # with PerMessageDeflate.cachekey().
+    #======================================================================
+    def __init__(self, size=DEFLATE_CACHE_SIZE, maxbytes=DEFLATE_CACHE_BYTES):
+        self.entries = OrderedDict()
+        self.size = size
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        self.entries[key] = entry
+        self.hits += 1
+        
+        return entry[0]
+    
+    def put(self, key, value, size):
+        if size > self.maxbytes:
+            return
+        
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        
+        self.entries[key] = (value, size)
+        self.bytes += size
+        
+        while len(self.entries) > self.size or self.bytes > self.maxbytes:
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+
+class PerMessageDeflate(object):
+    #======================================================================
+    # Compressor and decompressor for one connection. client_bits is None
+    # when the client didn't offer client_max_window_bits, it may then
+    # use a window of up to 15 bits.
+    #======================================================================
+    def __init__(self, server_no_context_takeover=False, client_no_context_takeover=False,
+            server_bits=15, client_bits=None, memlevel=DEFLATE_MEMLEVEL, level=DEFLATE_LEVEL):
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_bits = server_bits
+        self.client_bits = client_bits
+        self.memlevel = memlevel
+        self.level = level
+        
+        self.compressor = None
+        self.decompressor = None
+        self.inflated = 0
+    
+    def cachekey(self):
+        #==================================================================
+        # What the compressed bytes of a message depend on, or None when
+        # they also depend on earlier messages and can't be shared.
+        #==================================================================
+        if self.server_no_context_takeover:
+            return (self.server_bits, self.memlevel, self.level)
+        
+        return None
+    
+    def compress(self, data):
+        #==================================================================
+        # Compress a whole message. Without context takeover a full flush
+        # resets the window, so the next message doesn't refer back to
+        # this one and we keep the same compressor.
+        #==================================================================
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.server_bits,
+                self.memlevel)
+        
+        if self.server_no_context_takeover:
+            mode = zlib.Z_FULL_FLUSH
+        else:
+            mode = zlib.Z_SYNC_FLUSH
+        
+        data = self.compressor.compress(data) + self.compressor.flush(mode)
+        
+        if data.endswith(_TAIL):
+            data = data[:-4]
+        
+        return data
+    
+    def decompress(self, data, final, maxsize):
+        #==================================================================
+        # Inflate the payload of one frame of a compressed message. Raises
+        # if the message inflates to more than maxsize bytes in total.
+        #==================================================================
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(-max(self.client_bits or 15, 9))
+        
+        if final:
+            data = bytes(data) + _TAIL
+        
+        data = self.decompressor.decompress(data, maxsize - self.inflated + 1)
+        self.inflated += len(data)
+        
+        if self.inflated > maxsize or self.decompressor.unconsumed_tail:
+            raise Exception('error: payload exceeded allowable size')
+        
+        if final:
+            self.inflated = 0
+        
+        return data
+    
+    def response(self):
+        #==================================================================
+        # The Sec-WebSocket-Extensions value for the handshake response.
+        #==================================================================
+        params = [EXTENSION_NAME]
+        
+        if self.server_no_context_takeover:
+            params.append('server_no_context_takeover')
+        
+        if self.client_no_context_takeover:
+            params.append('client_no_context_takeover')
+        
+        if self.server_bits < 15:
+            params.append('server_max_window_bits=%s' % self.server_bits)
+        
+        if self.client_bits is not None:
+            params.append('client_max_window_bits=%s' % self.client_bits)
+        
+        return '; '.join(params)
\ No newline at end of file
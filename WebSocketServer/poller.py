@@ -0,0 +1,144 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+from    select      import  select
+
+try:
+    import  selectors
+except ImportError:
+    selectors = None
+
+#==========================================================================
+# Event masks, these have the same values as selectors.EVENT_READ and
+# selectors.EVENT_WRITE.
+#==========================================================================
+READ            = 0x01
+WRITE           = 0x02
+
+class SelectPoller(object):
+    #======================================================================
+    # Fallback for interpreters without selectors. Registrations are kept
+    # in sets so updating them is cheap, but select() itself is still
+    # O(n) and limited to FD_SETSIZE descriptors.
+    #======================================================================
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+    
+    def close(self):
+        self.readers.clear()
+        self.writers.clear()
+    
+    def modify(self, fileno, events):
+        if events & READ:
+            self.readers.add(fileno)
+        else:
+            self.readers.discard(fileno)
+        
+        if events & WRITE:
+            self.writers.add(fileno)
+        else:
+            self.writers.discard(fileno)
+    
+    def poll(self, timeout=None):
+        ready, writers, failed = select(self.readers, self.writers, self.readers, timeout)
+        events = {}
+        
+        for fileno in ready:
+            events[fileno] = READ
+        
+        #==================================================================
+        # Report errors as readable, the next recv will raise and the
+        # connection gets cleaned up.
+        #==================================================================
+        for fileno in failed:
+            events[fileno] = READ
+        
+        for fileno in writers:
+            events[fileno] = events.get(fileno, 0) | WRITE
+        
+        return list(events.items())
+    
+    def register(self, fileno, events):
+        self.modify(fileno, events)
+    
+    def unregister(self, fileno):
+        self.readers.discard(fileno)
+        self.writers.discard(fileno)
+
+class SelectorPoller(object):
+    #======================================================================
+    # Persistent registrations on top of selectors.DefaultSelector, which
+    # is epoll on Linux and kqueue on BSD. The cost of poll() depends on
+    # the number of ready descriptors, not the number registered.
+    #======================================================================
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.events = {}
+    
+    def close(self):
+        self.selector.close()
+        self.events.clear()
+    
+    def modify(self, fileno, events):
+        #==================================================================
+        # selectors won't hold a descriptor with no events, so one with
+        # nothing to wait for is taken out of the selector but remembered.
+        #==================================================================
+        current = self.events.get(fileno, 0)
+        
+        if current == events:
+            return
+        
+        self.events[fileno] = events
+        
+        if current == 0:
+            self.selector.register(fileno, events)
+        elif events == 0:
+            self.selector.unregister(fileno)
+        else:
+            self.selector.modify(fileno, events)
+    
+    def poll(self, timeout=None):
+        return [(key.fd, events) for key, events in self.selector.select(timeout)]
+    
+    def register(self, fileno, events):
+        if fileno in self.events:
+            self.unregister(fileno)
+        
+        self.modify(fileno, events)
+    
+    def unregister(self, fileno):
+        events = self.events.pop(fileno, 0)
+        
+        if events != 0:
+            try:
+                self.selector.unregister(fileno)
+            except (KeyError, ValueError):
+                pass
+
+if selectors is not None:
+    DefaultPoller = SelectorPoller
+else:
+    DefaultPoller = SelectPoller
\ No newline at end of file
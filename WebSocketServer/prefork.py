@@ -0,0 +1,197 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+from    .broadcastbus       import  BroadcastBus, BroadcastHub
+from    .websocketserver    import  BACKLOG, _listen
+
+import  errno
+import  os
+import  signal
+import  socket
+import  sys
+import  time
+
+#==========================================================================
+# A worker that dies sooner than this after being started is restarted
+# after a delay so a broken worker doesn't turn into a fork loop.
+#==========================================================================
+RESTART_DELAY   = 1.0
+
+#==========================================================================
+# How often the supervisor checks for exited workers while it is relaying
+# broadcast messages.
+#==========================================================================
+REAP_INTERVAL   = 0.5
+
+class Supervisor(object):
+    #======================================================================
+    # Forks a number of worker processes that each run their own server
+    # and restarts any that exit. SIGINT and SIGTERM are passed on to the
+    # workers and the supervisor exits once they have all stopped.
+    #
+    # factory is called in each worker with the keyword arguments
+    # reuse_port, master and bus and returns the server to run. Where
+    # SO_REUSEPORT is available every worker binds its own socket and the
+    # kernel balances connections between them, otherwise master is a
+    # listening socket bound here and inherited by all the workers. bus is
+    # the worker's BroadcastBus, or None when broadcast is False.
+    #======================================================================
+    def __init__(self, host, port, workers, factory, broadcast=True, backlog=BACKLOG):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.factory = factory
+        self.backlog = backlog
+        self.master = None
+        self.hub = BroadcastHub() if broadcast else None
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        self.pids = {}
+        self.started = {}
+        self.running = False
+    
+    def _spawn(self, slot):
+        bus = None
+        
+        if self.hub is not None:
+            bus = self.hub.connect(slot)
+        
+        pid = os.fork()
+        
+        if pid == 0:
+            self._worker(bus)
+        
+        if bus is not None:
+            bus.close()
+        
+        self.pids[pid] = slot
+        self.started[slot] = time.time()
+    
+    def _stop(self, signum, frame):
+        self.running = False
+        
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+    
+    def _worker(self, bus):
+        status = 0
+        
+        self.pids = {}
+        
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            
+            if bus is not None:
+                self.hub.close()
+                bus = BroadcastBus(bus)
+            
+            server = self.factory(reuse_port=self.reuse_port, master=self.master, bus=bus)
+            
+            def close_sig_handler(signum, frame):
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                server.close()
+                sys.exit()
+            
+            signal.signal(signal.SIGINT, close_sig_handler)
+            signal.signal(signal.SIGTERM, close_sig_handler)
+            server.run()
+        except SystemExit as ex:
+            status = ex.code if isinstance(ex.code, int) else 0
+        except BaseException as ex:
+            sys.stderr.write('%s\n' % str(ex))
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+    
+    def run(self):
+        #==================================================================
+        # Make sure we can bind before forking so a bad address fails once
+        # here instead of in every worker.
+        #==================================================================
+        try:
+            master = _listen(self.host, self.port, self.reuse_port, self.backlog)
+        except Exception as ex:
+            sys.stderr.write('%s\n' % str(ex))
+            sys.exit(2)
+        
+        if self.reuse_port:
+            master.close()
+        else:
+            self.master = master
+        
+        self.running = True
+        
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+        
+        for slot in range(self.workers):
+            self._spawn(slot)
+        
+        #==================================================================
+        # Without a hub there is nothing to do but wait for workers to
+        # exit, with one we relay messages and check for exits between.
+        #==================================================================
+        while self.pids:
+            options = 0
+            
+            if self.hub is not None:
+                self.hub.poll(REAP_INTERVAL)
+                options = os.WNOHANG
+            
+            try:
+                pid, status = os.waitpid(-1, options)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                
+                break
+            
+            if pid == 0:
+                continue
+            
+            slot = self.pids.pop(pid, None)
+            
+            if slot is None or self.running is False:
+                continue
+            
+            sys.stderr.write('error: worker %s (pid %s) exited with status %s, restarting\n'
+                % (slot, pid, status))
+            
+            if time.time() - self.started[slot] < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            
+            if self.running:
+                self._spawn(slot)
+        
+        if self.master is not None:
+            self.master.close()
+        
+        if self.hub is not None:
+            self.hub.close()
\ No newline at end of file
@@ -0,0 +1,180 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# Runs a WebSocket's processhandler on messages in
+# worker processes, for CPU bound work the GIL would
+# otherwise keep on one core.
+#
+# Payloads and results of SHM_THRESHOLD bytes or
+# more are passed through shared memory rather than
+# pickled down the executor's pipes.
+#===================================================
+
+import  multiprocessing
+import  sys
+
+try:
+    from    concurrent.futures  import  ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
+try:
+    from    multiprocessing     import  resource_tracker, shared_memory
+except ImportError:
+    resource_tracker = shared_memory = None
+
+SHM_THRESHOLD   = 1048576
+
+#==========================================================================
+# How a payload or result travels: VALUE is pickled, SHM is the name and
+# size of a shared memory block holding its bytes.
+#==========================================================================
+VALUE           = 0
+SHM             = 1
+
+def _to_shm(data):
+    block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    block.buf[:len(data)] = data
+    
+    return block
+
+def _from_shm(name, size, unlink):
+    block = shared_memory.SharedMemory(name)
+    
+    try:
+        return bytes(block.buf[:size])
+    finally:
+        block.close()
+        
+        if unlink:
+            block.unlink()
+
+def _run(func, payload, threshold):
+    #======================================================================
+    # Runs in a worker process. The message is given to func as a unicode
+    # string or a bytearray, like self.data in handle_message.
+    #======================================================================
+    kind, data, text = payload
+    
+    if kind == SHM:
+        data = _from_shm(data[0], data[1], False)
+        data = data.decode('utf-8') if text else bytearray(data)
+    elif not text and not isinstance(data, bytearray):
+        data = bytearray(data)
+    
+    result = func(data)
+    
+    if isinstance(result, (bytes, bytearray)) and shared_memory is not None and len(result) >= threshold:
+        #==================================================================
+        # The parent unlinks the block once it has read it.
+        #==================================================================
+        block = _to_shm(result)
+        block.close()
+        
+        return (SHM, (block.name, len(result)), False)
+    
+    return (VALUE, result, False)
+
+class ProcessPool(object):
+    def __init__(self, processes, threshold=SHM_THRESHOLD):
+        #==================================================================
+        # Workers are forked where we can so the handler class, which may
+        # have been loaded from a file rather than imported, is there in
+        # them too. The resource tracker is started first so every worker
+        # shares it and shared memory names are only tracked once.
+        #==================================================================
+        context = None
+        
+        if 'fork' in getattr(multiprocessing, 'get_all_start_methods', list)():
+            context = multiprocessing.get_context('fork')
+        
+        if resource_tracker is not None:
+            resource_tracker.ensure_running()
+        
+        if sys.version_info >= (3, 7):
+            self.executor = ProcessPoolExecutor(processes, mp_context=context)
+        else:
+            self.executor = ProcessPoolExecutor(processes)
+        
+        self.threshold = threshold
+    
+    def result(self, future):
+        #==================================================================
+        # The result of a finished submit(), freeing any shared memory it
+        # used. Raises what the handler raised.
+        #==================================================================
+        block = future.shm
+        future.shm = None
+        
+        if block is not None:
+            block.close()
+            block.unlink()
+        
+        kind, data, text = future.result()
+        
+        if kind == SHM:
+            return _from_shm(data[0], data[1], True)
+        
+        return data
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+    
+    def submit(self, func, data, text):
+        #==================================================================
+        # Start func(data) in a worker and return a concurrent.futures
+        # Future, pass it to result() once it is done. func must be a
+        # module level function so it can be pickled. text is True for a
+        # TEXT message.
+        #==================================================================
+        block = None
+        
+        if shared_memory is not None and len(data) >= self.threshold:
+            if text:
+                data = data.encode('utf-8')
+            
+            block = _to_shm(data)
+            payload = (SHM, (block.name, len(data)), text)
+        else:
+            #==============================================================
+            # A spilled message is an mmap, which can't be pickled.
+            #==============================================================
+            if not text and not isinstance(data, bytearray):
+                data = bytearray(data)
+            
+            payload = (VALUE, data, text)
+        
+        try:
+            future = self.executor.submit(_run, func, payload, self.threshold)
+        except Exception:
+            if block is not None:
+                block.close()
+                block.unlink()
+            
+            raise
+        
+        future.shm = block
+        
+        return future
\ No newline at end of file
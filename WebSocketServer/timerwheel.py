@@ -0,0 +1,202 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# Hierarchical timing wheel for the server's
+# timeouts.
+#
+# Time is counted in ticks of TIMER_RESOLUTION
+# seconds. The first level has a slot for each of
+# the next TIMER_SLOTS ticks, each level above it
+# has slots TIMER_SLOTS times as wide. A timer goes
+# in the slot of the lowest level that reaches its
+# tick, and is moved down a level whenever the level
+# below wraps around, so adding and cancelling one
+# is O(1) however many there are.
+#===================================================
+
+import  sys
+import  time
+
+TIMER_RESOLUTION    = 0.1
+TIMER_SLOTS         = 256
+TIMER_LEVELS        = 3
+
+#==========================================================================
+# The clock timers run on, time.time() where there is no monotonic clock.
+#==========================================================================
+monotonic = getattr(time, 'monotonic', time.time)
+
+class Timer(object):
+    __slots__ = ('wheel', 'expires', 'func', 'args', 'slot')
+    
+    def __init__(self, wheel, expires, func, args):
+        self.wheel = wheel
+        self.expires = expires
+        self.func = func
+        self.args = args
+        self.slot = None
+    
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+class TimerWheel(object):
+    def __init__(self, resolution=TIMER_RESOLUTION, slots=TIMER_SLOTS, levels=TIMER_LEVELS):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.start = monotonic()
+        self.tick = 0
+        self.count = 0
+        
+        #==================================================================
+        # The first tick with anything to do, a timer to run or a level to
+        # move down, or None while the wheel is empty.
+        #==================================================================
+        self.next = None
+    
+    def _add(self, timer):
+        slots = self.slots
+        delta = timer.expires - self.tick
+        level = 0
+        span = 1
+        
+        while delta >= span * slots and level < len(self.levels) - 1:
+            level += 1
+            span *= slots
+        
+        #==================================================================
+        # Anything further out than the top level reaches waits in its
+        # furthest slot and is placed again when that comes round.
+        #==================================================================
+        expires = min(timer.expires, self.tick + span * slots - 1)
+        timer.slot = self.levels[level][(expires // span) % slots]
+        timer.slot.add(timer)
+        
+        if level == 0:
+            due = max(expires, self.tick)
+        else:
+            due = self.tick - self.tick % slots + slots
+        
+        if self.next is None or due < self.next:
+            self.next = due
+    
+    def _cascade(self):
+        #==================================================================
+        # Level 0 has just wrapped around, move the timers in the current
+        # slot of each level that has reached the end of a slot down.
+        #==================================================================
+        slots = self.slots
+        span = 1
+        
+        for level in range(1, len(self.levels)):
+            span *= slots
+            
+            if self.tick % span != 0:
+                break
+            
+            slot = self.levels[level][(self.tick // span) % slots]
+            
+            for timer in list(slot):
+                slot.discard(timer)
+                self._add(timer)
+    
+    def _find_next(self):
+        if self.count == 0:
+            self.next = None
+            return
+        
+        first = self.levels[0]
+        wrap = self.tick - self.tick % self.slots + self.slots
+        
+        for tick in range(self.tick + 1, wrap):
+            if first[tick % self.slots]:
+                self.next = tick
+                return
+        
+        self.next = wrap
+    
+    def advance(self, now=None):
+        #==================================================================
+        # Run the timers that are due. Ticks with nothing in them are
+        # skipped over rather than stepped through one by one.
+        #==================================================================
+        if now is None:
+            now = monotonic()
+        
+        target = int((now - self.start) / self.resolution)
+        
+        while self.next is not None and self.next <= target:
+            self.tick = self.next
+            
+            if self.tick % self.slots == 0:
+                self._cascade()
+            
+            slot = self.levels[0][self.tick % self.slots]
+            expired = list(slot)
+            slot.clear()
+            
+            for timer in expired:
+                timer.slot = None
+                self.count -= 1
+            
+            self._find_next()
+            
+            for timer in expired:
+                try:
+                    timer.func(*timer.args)
+                except Exception as ex:
+                    sys.stderr.write('%s\n' % str(ex))
+        
+        if target > self.tick:
+            self.tick = target
+    
+    def schedule(self, delay, func, *args):
+        #==================================================================
+        # Call func(*args) once delay seconds have passed, no sooner and
+        # up to resolution later. Returns a Timer that can be cancelled.
+        #==================================================================
+        expires = int(-(-(monotonic() + delay - self.start) // self.resolution))
+        timer = Timer(self, max(expires, self.tick + 1), func, args)
+        
+        self.count += 1
+        self._add(timer)
+        
+        return timer
+    
+    def timeout(self, now=None):
+        #==================================================================
+        # Seconds until advance() has something to do, for the poller's
+        # timeout. None while there are no timers.
+        #==================================================================
+        if self.next is None:
+            return None
+        
+        if now is None:
+            now = monotonic()
+        
+        return max(0.0, self.start + self.next * self.resolution - now)
\ No newline at end of file
@@ -0,0 +1,159 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# Server side TLS configuration.
+#
+# TLSConfig builds an SSLContext for TLS 1.2 and
+# 1.3 with ECDHE key exchange only and session
+# tickets, and replaces it every TLS_TICKET_ROTATION
+# seconds so the ticket keys, which the ssl module
+# has no way to set, are rotated with it. It also
+# counts full and resumed handshakes.
+#===================================================
+
+import  ssl
+import  sys
+import  time
+
+#==========================================================================
+# Forward secret AEAD ciphers for TLS 1.2, TLS 1.3 only has ciphers like
+# these and OpenSSL configures them separately.
+#==========================================================================
+TLS_CIPHERS             = 'ECDHE+AESGCM:ECDHE+CHACHA20'
+
+TLS_MINIMUM_VERSION     = '1.2'
+
+#==========================================================================
+# Seconds before the context, and with it the session ticket keys, is
+# replaced. Clients holding a ticket issued under the old keys do a full
+# handshake when they next connect. 0 keeps the first context for good,
+# which is what processes forked from one TLSConfig need to go on
+# accepting each other's tickets.
+#==========================================================================
+TLS_TICKET_ROTATION     = 3600
+
+_VERSIONS = {
+    '1.2': 'TLSv1_2',
+    '1.3': 'TLSv1_3',
+}
+
+class TLSConfig(object):
+    def __init__(self, certfile, keyfile, minimum_version=TLS_MINIMUM_VERSION,
+            ciphers=TLS_CIPHERS, tickets=True, rotation=TLS_TICKET_ROTATION):
+        if minimum_version not in _VERSIONS:
+            raise ValueError('error: unsupported TLS version: %s' % minimum_version)
+        
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.minimum_version = minimum_version
+        self.ciphers = ciphers
+        self.tickets = tickets
+        self.rotation = rotation
+        
+        self.full = 0
+        self.resumed = 0
+        self.rotations = 0
+        
+        self.context = self._create_context()
+        self.created = time.time()
+    
+    def _create_context(self):
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        context.options |= getattr(ssl, 'OP_NO_COMPRESSION', 0)
+        context.options |= getattr(ssl, 'OP_CIPHER_SERVER_PREFERENCE', 0)
+        context.options |= getattr(ssl, 'OP_SINGLE_ECDH_USE', 0)
+        
+        if hasattr(context, 'minimum_version'):
+            context.minimum_version = getattr(ssl.TLSVersion, _VERSIONS[self.minimum_version])
+        else:
+            #==============================================================
+            # Before Python 3.7 the older protocols have to be switched
+            # off one by one.
+            #==============================================================
+            context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+            context.options |= getattr(ssl, 'OP_NO_TLSv1', 0) | getattr(ssl, 'OP_NO_TLSv1_1', 0)
+            
+            if self.minimum_version == '1.3':
+                context.options |= getattr(ssl, 'OP_NO_TLSv1_2', 0)
+        
+        if self.tickets is False:
+            context.options |= ssl.OP_NO_TICKET
+        
+        context.set_ciphers(self.ciphers)
+        context.load_cert_chain(self.certfile, self.keyfile)
+        
+        return context
+    
+    def current(self):
+        #==================================================================
+        # The context to wrap a new connection with, rotated when it is
+        # due. Called on every accept so this has to stay cheap.
+        #==================================================================
+        if self.rotation > 0 and time.time() - self.created >= self.rotation:
+            self.rotate()
+        
+        return self.context
+    
+    def due(self):
+        #==================================================================
+        # Seconds until the next rotation, or None if there isn't one.
+        #==================================================================
+        if self.rotation <= 0:
+            return None
+        
+        return max(0.0, self.created + self.rotation - time.time())
+    
+    def handshaked(self, sslobj):
+        #==================================================================
+        # Count a completed handshake, sslobj is the SSLSocket or
+        # SSLObject of the connection.
+        #==================================================================
+        if getattr(sslobj, 'session_reused', False):
+            self.resumed += 1
+        else:
+            self.full += 1
+    
+    def rotate(self):
+        try:
+            context = self._create_context()
+        except Exception as ex:
+            #==============================================================
+            # Say if the certificate went missing but carry on with the
+            # context we have.
+            #==============================================================
+            sys.stderr.write('%s\n' % str(ex))
+            self.created = time.time()
+            return
+        
+        self.context = context
+        self.created = time.time()
+        self.rotations += 1
+    
+    def stats(self):
+        return {
+            'full': self.full,
+            'resumed': self.resumed,
+            'rotations': self.rotations,
+        }
\ No newline at end of file
@@ -22,16 +22,31 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-from    collections     import  deque
+from    .handshake          import  BAD_REQUEST, METHOD_NOT_ALLOWED, UPGRADE_REQUIRED
+from    .handshake          import  find_terminator, has_token, parse_request
+from    .masking            import  unmask
+from    .metrics            import  Metrics
+from    .permessagedeflate  import  DEFLATE_MAXMEMORY, DEFLATE_NO_CONTEXT_TAKEOVER, DEFLATE_THRESHOLD
+from    .permessagedeflate  import  DEFLATE_WINDOW_BITS, negotiate
+from    .timerwheel         import  monotonic
+from    collections         import  deque
+from    functools           import  partial
 
 import  base64
 import  codecs
 import  errno
 import  hashlib
-import  re
+import  mmap
+import  os
 import  socket
 import  struct
 import  sys
+import  tempfile
+
+try:
+    import  ssl
+except ImportError:
+    ssl = None
 
 VER = sys.version_info[0]
 
@@ -50,11 +65,60 @@ def _check_unicode(val):
     else:
         return isinstance(val, unicode)
 
+def _would_block(e):
+    #==========================================================================
+    # True for the errors a non-blocking send raises when the socket buffer
+    # is full, SSL sockets report it as wanting to write (or read).
+    #==========================================================================
+    if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+        return True
+    
+    return ssl is not None and isinstance(e, (ssl.SSLWantReadError, ssl.SSLWantWriteError))
+
+def _encode_frame(b1, data):
+    #==========================================================================
+    # Build a whole frame as an immutable buffer so the same frame can be
+    # queued to any number of clients. b1 is the first header byte (FIN,
+    # RSV and opcode), frames sent by the server are never masked.
+    #==========================================================================
+    if _check_unicode(data):
+        data = data.encode('utf-8')
+    
+    return _frame_header(b1, len(data)) + data
+
+def _frame_header(b1, length):
+    if length <= 125:
+        return struct.pack('!BB', b1, length)
+    elif length <= 65535:
+        return struct.pack('!BBH', b1, 126, length)
+    else:
+        return struct.pack('!BBQ', b1, 127, length)
+
+class _FileSegment(object):
+    #==========================================================================
+    # A BINARY message whose payload is count bytes of a file from offset,
+    # queued by send_file(). It sits in the sendq like any other frame but
+    # its payload is never read into memory as a whole and doesn't count
+    # towards sendqsize.
+    #==========================================================================
+    def __init__(self, fd, offset, count):
+        self.header = _frame_header(0x80 | BINARY, count)
+        self.headersent = 0
+        self.fd = fd
+        self.offset = offset
+        self.remaining = count
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
 HANDSHAKE_STR = (
     "HTTP/1.1 101 Switching Protocols\r\n"
     "Upgrade: WebSocket\r\n"
     "Connection: Upgrade\r\n"
-    "Sec-WebSocket-Accept: %(acceptstr)s\r\n\r\n"
+    "Sec-WebSocket-Accept: %(acceptstr)s\r\n"
+    "%(extensions)s\r\n"
 )
 
 GUID_STR = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
@@ -69,6 +133,11 @@ CLOSE           = 0x08
 PING            = 0x09
 PONG            = 0x0A
 
+#==========================================================================
+# Parser states. The frame parser reads whole headers at a time so it only
+# ever moves between HEADERB1 and PAYLOAD, the other values are kept for
+# code that inspects the state.
+#==========================================================================
 HEADERB1        = 1
 HEADERB2        = 3
 LENGTHSHORT     = 4
@@ -79,6 +148,70 @@ PAYLOAD         = 7
 MAXHEADER       = 65536
 MAXPAYLOAD      = 33554432
 
+#==========================================================================
+# BINARY messages of this many bytes or more are written to a temporary
+# file as they arrive and handle_message gets a read-only mmap of it
+# instead of a bytearray. None keeps every message in memory.
+#==========================================================================
+SPILL_THRESHOLD = 8388608
+
+#==========================================================================
+# Limits on how much of the sendq is gathered into one sendmsg() call.
+#==========================================================================
+SENDMSG_MAXIOV  = 64
+SENDMSG_MAXSIZE = 262144
+
+#==========================================================================
+# The most send_file() passes to one os.sendfile() call, or reads at a
+# time where it can't be used (TLS, asyncio).
+#==========================================================================
+SENDFILE_CHUNK  = 1048576
+
+#==========================================================================
+# Send queue watermarks in bytes. Once a client has SENDQ_HIGH queued we
+# stop reading from it and send_message() returns False, handle_drain()
+# is called when it gets back down to SENDQ_LOW.
+#==========================================================================
+SENDQ_HIGH      = 4194304
+SENDQ_LOW       = 1048576
+
+#==========================================================================
+# What to do with a client that stays above the high watermark for more
+# than SLOW_TIMEOUT seconds. DISCONNECT closes it, DROP throws away the
+# messages waiting in its sendq and BLOCK leaves it paused until it
+# catches up. DROP falls back to DISCONNECT for a client compressing
+# with context takeover.
+#==========================================================================
+DISCONNECT      = 'disconnect'
+DROP            = 'drop'
+BLOCK           = 'block'
+
+SLOW_CONSUMER   = DISCONNECT
+SLOW_TIMEOUT    = 30.0
+
+#==========================================================================
+# When handlers run on a thread pool, the most handler calls a client can
+# have queued or running before we stop reading from it.
+#==========================================================================
+HANDLER_QUEUE   = 64
+
+#==========================================================================
+# Timeouts in seconds, 0 turns one off. A client has HANDSHAKE_TIMEOUT to
+# send its upgrade request, is sent a PING every PING_INTERVAL and is
+# disconnected once we haven't heard from it for IDLE_TIMEOUT. A close
+# frame stuck behind data the client hasn't read yet gets CLOSE_TIMEOUT
+# to go out before the connection is dropped.
+#==========================================================================
+HANDSHAKE_TIMEOUT   = 10.0
+PING_INTERVAL       = 30.0
+IDLE_TIMEOUT        = 90.0
+CLOSE_TIMEOUT       = 5.0
+
+#==========================================================================
+# Weight of each new round trip time in the smoothed rtt (as TCP, RFC 6298).
+#==========================================================================
+RTT_SMOOTHING   = 0.125
+
 class HTTPRequest(BaseHTTPRequestHandler):
     def __init__(self, request_text):
         if VER >= 3:
@@ -99,25 +232,114 @@ class WebSocket(object):
         
         self.handshaked = False
         self.headerbuffer = bytearray()
+        self.headerscan = 0
         self.headertoread = 2048
+        self.headers = None
+        self.resource = None
         
         self.fin = 0
         self.data = bytearray()
         self.opcode = 0
+        self.frame_data = bytearray()
+        self.frame_opcode = 0
+        self.frame_compressed = False
+        self.frame_streamed = False
+        self.frame_spilled = False
         self.hasmask = 0
         self.maskarray = None
         self.length = 0
-        self.lengtharray = None
         self.index = 0
-        self.request = None
-        self.usingssl = False
+        self.headerpartial = bytearray()
+        self._request = None
+        self.usingssl = ssl is not None and isinstance(sock, ssl.SSLSocket)
+        
+        #======================================================================
+        # Plain sockets can write several queued frames with one sendmsg(),
+        # SSL sockets don't support it so they fall back to send().
+        #======================================================================
+        self.usesendmsg = hasattr(sock, 'sendmsg') and not self.usingssl
+        
+        #======================================================================
+        # send_file() hands file data to os.sendfile() where it can, under SSL
+        # (and asyncio) it is read in chunks and sent like any other data.
+        #======================================================================
+        self.usesendfile = hasattr(os, 'sendfile') and isinstance(sock, socket.socket) and not self.usingssl
         
         self.frag_start = False
         self.frag_type = BINARY
+        self.frag_compressed = False
         self.frag_buffer = None
         self.frag_decoder = codecs.getincrementaldecoder('utf-8')(errors='strict')
+        
+        #======================================================================
+        # When streaming is True (set it in __init__ or handle_connected) data
+        # messages are passed to handle_message_start, handle_message_chunk
+        # and handle_message_end as they arrive instead of being collected
+        # for handle_message.
+        #======================================================================
+        self.streaming = False
         self.closed = False
         self.sendq = deque()
+        self.sendoffset = 0
+        self.topics = set()
+        
+        #======================================================================
+        # Backpressure, sendqsize is the number of bytes in the sendq that
+        # haven't been written yet. See SENDQ_HIGH and SLOW_CONSUMER.
+        #======================================================================
+        self.sendqsize = 0
+        self.sendqhigh = SENDQ_HIGH
+        self.sendqlow = SENDQ_LOW
+        self.slowconsumer = SLOW_CONSUMER
+        self.slowtimeout = SLOW_TIMEOUT
+        self.throttled = False
+        self.throttledsince = None
+        
+        #======================================================================
+        # When inbox is a deque handler calls are queued on it instead of
+        # being made straight away, the server runs them later.
+        #======================================================================
+        self.inbox = None
+        self.handlerqueue = HANDLER_QUEUE
+        
+        #======================================================================
+        # Set processhandler to a module level function to have it called
+        # with each data message in a worker process, see --processes, and
+        # whatever it returns sent back instead of calling handle_message.
+        # replies holds the calls still to be answered, in order.
+        #======================================================================
+        self.processhandler = None
+        self.replies = deque()
+        
+        #======================================================================
+        # See HANDSHAKE_TIMEOUT. The timers are run by the server, lastread
+        # is when data last arrived from the client.
+        #======================================================================
+        self.handshaketimeout = HANDSHAKE_TIMEOUT
+        self.pinginterval = PING_INTERVAL
+        self.idletimeout = IDLE_TIMEOUT
+        self.closetimeout = CLOSE_TIMEOUT
+        self.handshaketimer = None
+        self.pingtimer = None
+        self.idletimer = None
+        self.closetimer = None
+        self.lastread = monotonic()
+        
+        #======================================================================
+        # Round trip times in seconds, measured with the PINGs we send and
+        # None until the first PONG comes back. rtt is smoothed. pingpayload
+        # and pingsent are the PING we are waiting on.
+        #======================================================================
+        self.rtt = None
+        self.rttmin = None
+        self.rttmax = None
+        self.pingpayload = None
+        self.pingsent = None
+        
+        #======================================================================
+        # The server's metrics, which frames are counted in.
+        #======================================================================
+        self.metrics = getattr(master, 'metrics', None) or Metrics()
         
         self.state = HEADERB1
         
@@ -126,6 +348,97 @@ class WebSocket(object):
         #======================================================================
         self.maxheader = MAXHEADER
         self.maxpayload = MAXPAYLOAD
+        
+        #======================================================================
+        # Payload bytes of the message being received so far, maxpayload
+        # applies to the whole message as well as each frame of it.
+        #======================================================================
+        self.messagesize = 0
+        
+        #======================================================================
+        # spill is the temporary file of the message being received once it
+        # has gone over spillthreshold.
+        #======================================================================
+        self.spillthreshold = SPILL_THRESHOLD
+        self.spill = None
+        
+        #======================================================================
+        # permessage-deflate is offered when the server was started with
+        # deflate, deflate holds the negotiated state. See permessagedeflate
+        # for the settings.
+        #======================================================================
+        self.usedeflate = getattr(master, 'deflate', False)
+        self.deflate = None
+        self.deflatethreshold = DEFLATE_THRESHOLD
+        self.deflatememory = DEFLATE_MAXMEMORY
+        self.deflatewindowbits = DEFLATE_WINDOW_BITS
+        self.deflatenocontext = DEFLATE_NO_CONTEXT_TAKEOVER
+    
+    def _accepted(self):
+        #======================================================================
+        # Called by the server once it is polling the connection and any TLS
+        # handshake is done, the client has handshaketimeout from now to
+        # complete the upgrade.
+        #======================================================================
+        self.handshaketimer = self._start_timer(self.handshaketimeout, self._handshake_timeout)
+    
+    def _cancel_timers(self):
+        for timer in [self.handshaketimer, self.pingtimer, self.idletimer, self.closetimer]:
+            if timer is not None:
+                timer.cancel()
+        
+        self.handshaketimer = self.pingtimer = self.idletimer = self.closetimer = None
+    
+    def _check_slow_consumer(self):
+        #======================================================================
+        # Called by the server every so often while we are throttled, applies
+        # the slow consumer policy once we've been over the high watermark
+        # for longer than slowtimeout.
+        #======================================================================
+        if self.throttled is False or self.closed is True or self.slowconsumer == BLOCK:
+            return
+        
+        if monotonic() - self.throttledsince < self.slowtimeout:
+            return
+        
+        #======================================================================
+        # With context takeover each compressed frame refers back to the ones
+        # before it, so dropping any would corrupt the rest of the stream and
+        # the client is disconnected instead.
+        #======================================================================
+        if self.slowconsumer == DROP and (self.deflate is None or self.deflate.cachekey() is not None):
+            self._drop_queued()
+        else:
+            sys.stderr.write('error: slow consumer, %s bytes queued. Resource #%s\n'
+                % (self.sendqsize, self.fileno))
+            self.close(1008, u'slow consumer')
+    
+    def _dispatch(self, handler, opcode, data):
+        #======================================================================
+        # Handlers see the message through self.opcode and self.data. The
+        # parser keeps its own state in frame_opcode and frame_data so a
+        # queued call can be run later without the next frame getting in
+        # the way.
+        #======================================================================
+        if self.inbox is None:
+            self.opcode = opcode
+            self.data = data
+            handler()
+        else:
+            self.inbox.append((handler, opcode, data))
+            
+            if self.master is not None:
+                self.master._queued(self)
+    
+    def _call(self, func, *args):
+        #======================================================================
+        # Run func on the server's event loop. Handlers running on a thread
+        # pool must leave the sendq and the server's state to that thread.
+        #======================================================================
+        if self.master is not None and self.master._off_loop():
+            self.master._call_soon(partial(func, *args))
+        else:
+            func(*args)
     
     def _do_handshake(self, data):
         #==================================================================
@@ -133,79 +446,198 @@ class WebSocket(object):
         #==================================================================
         self.headerbuffer.extend(data)
         
-        if len(self.headerbuffer) >= self.maxheader:
-            raise Exception('errro: header exceeded allowable size')
+        #==================================================================
+        # Look for the end of the HTTP header, only in the data that has
+        # just arrived.
+        #==================================================================
+        end = find_terminator(self.headerbuffer, self.headerscan)
+        self.headerscan = len(self.headerbuffer)
+        
+        if end == -1:
+            if len(self.headerbuffer) >= self.maxheader:
+                raise Exception('errro: header exceeded allowable size')
+            
+            return
         
         #==================================================================
-        # Indictaes end of HTTP header.
+        # Handshake RFC 6455
         #==================================================================
-        if b'\r\n\r\n' in self.headerbuffer:
-            self.request = HTTPRequest(self.headerbuffer)
+        try:
+            request = parse_request(self.headerbuffer[:end])
+            
+            if request is None:
+                return self._reject(BAD_REQUEST)
+            
+            method, self.resource, headers = request
+            
+            if method != 'GET':
+                return self._reject(METHOD_NOT_ALLOWED)
             
             #==============================================================
-            # Handshake RFC 6455
+            # A plain GET of the server's metricspath gets the metrics.
             #==============================================================
-            try:
-                match = re.compile('GET (.*) HTTP')
-                match = match.search(self.headerbuffer.decode('utf-8'))
-                
-                if match is not None and len(match.groups()) == 1:
-                    self.resource = match.group(1)
-                else:
-                    self.response = 'HTTP/1.1 405 Method Not Allowed\r\n\r\n'
-                
-                headers = self.request.headers
-                
-                if not 'Host' in headers:
-                    self.response = 'HTTP/1.1 400 Bad Request\r\n\r\n'
-                
-                if not 'Upgrade' in headers or not headers['Upgrade'] == 'websocket':
-                    self.response = 'HTTP/1.1 400 Bad Request\r\n\r\n'
-                
-                if not 'Connection' in headers or headers['Connection'].find('Upgrade') == -1:
-                    self.response = 'HTTP/1.1 400 Bad Request\r\n\r\n'
-                
-                if not 'Sec-WebSocket-Key' in headers:
-                    self.response = 'HTTP/1.1 400 Bad Request\r\n\r\n'
-                
-                if not 'Sec-WebSocket-Version' in headers or not headers['Sec-WebSocket-Version'] == '13':
-                    self.response = 'HTTP/1.1 426 Upgrade Required\r\nSec-WebSocketVersion: 13\r\n\r\n'
-                
-                if hasattr(self, 'response'):
-                    try:
-                        close_msg = bytearray()
-                        close_msg.extend(struct.pack('!H', 1000))
-                        
-                        if _check_unicode(self.response):
-                            close_msg.extend(self.response.encode('utf-8'))
-                        else:
-                            close_msg.extend(self.response)
-                        
-                        self._send_message(False, CLOSE, close_msg)
-                    finally:
-                        return
+            metricspath = getattr(self.master, 'metricspath', None)
+            
+            if (metricspath is not None and self.resource.split('?', 1)[0] == metricspath
+                    and not has_token(headers.get('Upgrade', ''), 'websocket')):
+                return self._respond(self.metrics.response())
+            
+            if (not 'Host' in headers or not 'Sec-WebSocket-Key' in headers
+                    or not has_token(headers.get('Upgrade', ''), 'websocket')
+                    or not has_token(headers.get('Connection', ''), 'upgrade')):
+                return self._reject(BAD_REQUEST)
+            
+            if headers.get('Sec-WebSocket-Version') != '13':
+                return self._reject(UPGRADE_REQUIRED)
+            
+            self.headers = headers
+            
+            key = headers['Sec-WebSocket-Key']
+            key = key.encode('ascii') + GUID_STR.encode('ascii')
+            key = base64.b64encode(hashlib.sha1(key).digest()).decode('ascii')
+            extensions = ''
+            
+            if self.usedeflate and 'Sec-WebSocket-Extensions' in headers:
+                self.deflate = negotiate([headers['Sec-WebSocket-Extensions']],
+                    self.deflatewindowbits, self.deflatenocontext, self.deflatememory)
                 
-                key = headers['Sec-WebSocket-Key']
-                key = key.encode('ascii') + GUID_STR.encode('ascii')
-                key = base64.b64encode(hashlib.sha1(key).digest()).decode('ascii')
-                hstr = HANDSHAKE_STR % {'acceptstr': key}
+                if self.deflate is not None:
+                    extensions = 'Sec-WebSocket-Extensions: %s\r\n' % self.deflate.response()
+            
+            hstr = HANDSHAKE_STR % {'acceptstr': key, 'extensions': extensions}
+            
+            self._queue(BINARY, hstr.encode('ascii'))
+            self.handshaked = True
+            self.metrics.handshakes.value += 1
+            
+            if self.handshaketimer is not None:
+                self.handshaketimer.cancel()
+                self.handshaketimer = None
+            
+            self._dispatch(self.handle_connected, self.opcode, self.data)
+            self._dispatch(self._keepalive, self.opcode, self.data)
+        except Exception as ex:
+            raise Exception('error: handshake failed: %s' % str(ex))
+        
+        #==================================================================
+        # Keep only the request for self.request, anything the client sent
+        # after it is the start of its first frame.
+        #==================================================================
+        rest = self.headerbuffer[end + 4:]
+        del self.headerbuffer[end + 4:]
+        
+        if rest and self.closed is False:
+            self._parse_message(rest)
+    
+    def _reject(self, response):
+        #==================================================================
+        # Answer a request we won't upgrade in plain HTTP and hang up, the
+        # client doesn't understand WebSocket frames yet.
+        #==================================================================
+        sys.stderr.write('error: handshake rejected: %s\n' % response.split('\r\n', 1)[0])
+        self.metrics.rejected.value += 1
+        self._respond(response.encode('ascii'))
+    
+    def _respond(self, response):
+        #==================================================================
+        # Send a plain HTTP response and hang up. It is queued as a CLOSE
+        # so the connection is closed once it has all been written, which
+        # gets closetimeout if it doesn't go in one send.
+        #==================================================================
+        try:
+            self._queue(CLOSE, response)
+            self._send_queue()
+        except Exception:
+            pass
+        finally:
+            self.closed = True
+        
+        if self.sendq and self.closetimeout and self.master is not None:
+            self.closetimer = self._start_timer(self.closetimeout, self._close_timeout)
+            self.master._want_write(self)
+            return
+        
+        self.close()
+    
+    def _close_timeout(self):
+        self.closetimer = None
+        
+        sys.stderr.write('error: close timed out. Resource #%s\n' % self.fileno)
+        
+        #======================================================================
+        # Reset the connection rather than leave the kernel (or the asyncio
+        # transport) holding on to data the client isn't reading.
+        #======================================================================
+        try:
+            if hasattr(self.sock, 'abort'):
+                self.sock.abort()
+            else:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except Exception as ex:
+            sys.stderr.write('%s\n' % str(ex))
+        
+        self.close()
+    
+    def _drop_queued(self):
+        #======================================================================
+        # Throw away queued data frames. The head of the sendq is kept as it
+        # may be part written and so are control frames.
+        #======================================================================
+        if not self.sendq:
+            return
+        
+        head = self.sendq.popleft()
+        kept = deque([head])
+        dropped = 0
+        size = 0
+        
+        if not isinstance(head[1], _FileSegment):
+            size = len(head[1]) - self.sendoffset
+        
+        for opcode, payload in self.sendq:
+            if opcode >= CLOSE:
+                kept.append((opcode, payload))
+                size += len(payload)
+            else:
+                if isinstance(payload, _FileSegment):
+                    payload.close()
                 
-                self.sendq.append((BINARY, hstr.encode('ascii')))
-                self.handshaked = True
-                self.handle_connected()
-            except Exception as ex:
-                raise Exception('error: handshake failed: %s' % str(ex))
+                dropped += 1
+        
+        self.sendq = kept
+        self.sendqsize = size
+        
+        if dropped > 0:
+            sys.stderr.write('error: slow consumer, dropped %s queued messages. Resource #%s\n'
+                % (dropped, self.fileno))
+        
+        self._update_throttle()
+    
+    def _frag_extend(self, data):
+        #======================================================================
+        # Add to a fragmented BINARY message, moving it into a temporary file
+        # once it reaches spillthreshold.
+        #======================================================================
+        if self.spill is not None:
+            self.spill.write(data)
+        elif self.spillthreshold is not None and len(self.frag_buffer) + len(data) >= self.spillthreshold:
+            self.spill = tempfile.TemporaryFile()
+            self.spill.write(self.frag_buffer)
+            self.spill.write(data)
+            self.frag_buffer = None
+        else:
+            self.frag_buffer.extend(data)
     
     def _handle_close(self):
         status = 1000
         reason = u''
-        length = len(self.data)
+        length = len(self.frame_data)
         
         if length == 0:
             pass
         elif length >= 2:
-            status = struct.unpack_from('!H', self.data[:2])[0]
-            reason = self.data[2:]
+            status = struct.unpack_from('!H', self.frame_data[:2])[0]
+            reason = self.frame_data[2:]
             
             if status not in _VALID_STATUS_CODES:
                 status = 1002
@@ -231,41 +663,89 @@ class WebSocket(object):
         finally:
             pass
     
+    def _handle_pong(self):
+        #======================================================================
+        # A PONG echoes the payload of the PING it answers. Unsolicited ones
+        # and answers to a PING we have since replaced are ignored.
+        #======================================================================
+        if self.pingpayload is None or self.frame_data != self.pingpayload:
+            return
+        
+        rtt = monotonic() - self.pingsent
+        self.pingpayload = None
+        self.pingsent = None
+        
+        if self.rtt is None:
+            self.rtt = self.rttmin = self.rttmax = rtt
+        else:
+            self.rtt += (rtt - self.rtt) * RTT_SMOOTHING
+            self.rttmin = min(self.rttmin, rtt)
+            self.rttmax = max(self.rttmax, rtt)
+        
+        if self.master is not None:
+            self.master.latency.observe(rtt)
+    
+    def _handshake_timeout(self):
+        self.handshaketimer = None
+        
+        if self.handshaked is True or self.closed is True:
+            return
+        
+        #======================================================================
+        # The client doesn't speak WebSocket yet so just hang up.
+        #======================================================================
+        sys.stderr.write('error: handshake timed out. Resource #%s\n' % self.fileno)
+        self.closed = True
+        self.close()
+    
     def _handle_data(self):
+        #======================================================================
+        # An SSL socket can hold decrypted data that the poller doesn't know
+        # about, so keep reading until it has none left.
+        #======================================================================
+        self._read()
+        
+        while self.usingssl and self.closed is False and self.sock.pending() > 0:
+            self._read()
+    
+    def _read(self):
+        try:
+            if self.handshaked is False:
+                data = self.sock.recv(self.headertoread)
+            else:
+                data = self.sock.recv(16384)
+        except socket.error as e:
+            #==================================================================
+            # Nothing to read after all, e.g. only part of an SSL record has
+            # arrived.
+            #==================================================================
+            if _would_block(e):
+                return
+            
+            raise e
+        
+        if not data:
+            raise Exception('info: remote socket closed')
+        
         if self.handshaked is False:
             #==================================================================
             # Do the HTTP header and handshake.
             #==================================================================
-            data = self.sock.recv(self.headertoread)
-            
-            if not data:
-                raise Exception('info: remote socket closed')
-            
             self._do_handshake(data)
         else:
-            data = self.sock.recv(16384)
-            
-            if not data:
-                raise Exception('info: remote socket closed')
-            
-            if VER >= 3:
-                for d in data:
-                    self._parse_message(d)
-            else:
-                for d in data:
-                    self._parse_message(ord(d))
+            self._parse_message(data)
     
     def _handle_packet(self):
-        if self.opcode == BINARY:
+        if self.frame_opcode == BINARY:
             pass
-        elif self.opcode == CLOSE:
+        elif self.frame_opcode == CLOSE:
             pass
-        elif self.opcode == STREAM:
+        elif self.frame_opcode == STREAM:
             pass
-        elif self.opcode == TEXT:
+        elif self.frame_opcode == TEXT:
             pass
-        elif self.opcode == PONG or self.opcode == PING:
-            if len(self.data) > 125:
+        elif self.frame_opcode == PONG or self.frame_opcode == PING:
+            if len(self.frame_data) > 125:
                 raise Exception('error: control frame length can not be > 125')
         else:
             #==================================================================
@@ -273,7 +753,7 @@ class WebSocket(object):
             #==================================================================
             raise Exception('error: unknown opcode')
         
-        if self.opcode == CLOSE:
+        if self.frame_opcode == CLOSE:
             self._handle_close()
         elif self.fin == 0:
             self._handle_no_fin()
@@ -281,316 +761,757 @@ class WebSocket(object):
             self._handle_other()
     
     def _handle_no_fin(self):
-        if self.opcode != STREAM:
-            if self.opcode == PING or self.opcode == PONG:
+        if self.frame_opcode != STREAM:
+            if self.frame_opcode == PING or self.frame_opcode == PONG:
                 raise Exception('error: control messages can not be fragmented')
             
-            self.frag_type = self.opcode
+            self.frag_type = self.frame_opcode
             self.frag_start = True
+            self.frag_compressed = self.frame_compressed
             self.frag_decoder.reset()
+            data = self._inflate(self.frame_data, self.frag_compressed, False)
             
             if self.frag_type == TEXT:
                 self.frag_buffer = []
-                utf_str = self.frag_decoder.decode(self.data, final=False)
+                utf_str = self.frag_decoder.decode(data, final=False)
                 
                 if utf_str:
                     self.frag_buffer.append(utf_str)
-            else:
+            elif self.frame_spilled is False:
                 self.frag_buffer = bytearray()
-                self.frag_buffer.extend(self.data)
+                self._frag_extend(data)
         else:
             if self.frag_start is False:
                 raise Exception('error: fragmentation protocol error')
             
+            data = self._inflate(self.frame_data, self.frag_compressed, False)
+            
             if self.frag_type == TEXT:
-                utf_str = self.frag_decoder.decode(self.data, final = False)
+                utf_str = self.frag_decoder.decode(data, final = False)
                 
                 if utf_str:
                     self.frag_buffer.append(utf_str)
-                else:
-                    self.frag_buffer.extend(self.data)
+            elif self.frame_spilled is False:
+                self._frag_extend(data)
     
     def _handle_other(self):
-        if self.opcode == STREAM:
+        if self.frame_opcode == STREAM:
             if self.frag_start is False:
                 raise Exception('error: fragmentation protocol error')
             
+            data = self._inflate(self.frame_data, self.frag_compressed, True)
+            
             if self.frag_type == TEXT:
-                utf_str = self.frag_decoder.decode(self.data, final=True)
+                utf_str = self.frag_decoder.decode(data, final=True)
                 self.frag_buffer.append(utf_str)
-                self.data = u''.join(self.frag_buffer)
+                data = u''.join(self.frag_buffer)
             else:
-                self.frag_buffer.extend(self.data)
-                self.data = self.frag_buffer
+                if self.frame_spilled is False:
+                    self._frag_extend(data)
+                
+                if self.spill is not None:
+                    data = self._spilled()
+                else:
+                    data = self.frag_buffer
             
-            self.handle_message()
+            self._dispatch(self._on_message, self.frame_opcode, data)
             
             self.frag_decoder.reset()
             self.frag_type = BINARY
             self.frag_start = False
             self.frag_buffer = None
-        elif self.opcode == PING:
-            self._sendMessage(False, PONG, self.data)
-        elif self.opcode == PONG:
-            pass
+        elif self.frame_opcode == PING:
+            self._send_message(False, PONG, self.frame_data)
+        elif self.frame_opcode == PONG:
+            self._handle_pong()
         else:
             if self.frag_start is True:
                 raise Exception('error: fragmentation protocol error')
             
-            if self.opcode == TEXT:
+            if self.frame_spilled:
+                data = self._spilled()
+            else:
+                data = self._inflate(self.frame_data, self.frame_compressed, True)
+                
+                #==============================================================
+                # A compressed frame can't be spilled as it arrives, so its
+                # inflated output is, as it would be if it were fragmented.
+                #==============================================================
+                if (self.frame_opcode == BINARY and self.spillthreshold is not None
+                        and len(data) >= self.spillthreshold):
+                    self.spill = tempfile.TemporaryFile()
+                    self.spill.write(data)
+                    data = self._spilled()
+            
+            if self.frame_opcode == TEXT:
                 try:
-                    self.data = self.data.decode('utf8', errors='strict')
+                    data = data.decode('utf8', errors='strict')
                 except Exception as exp:
                     raise Exception('error: invalid utf-8 payload')
             
-            self.handle_message()
+            self._dispatch(self._on_message, self.frame_opcode, data)
     
-    def _header_b1(self, byte):
-        self.fin = byte & 0x80
-        self.opcode = byte & 0x0F
-        self.state = HEADERB2
+    def _on_message(self):
+        if self.processhandler is not None:
+            return self.master._process(self, self.data)
         
-        self.index = 0
-        self.length = 0
-        self.lengtharray = bytearray()
-        self.data = bytearray()
+        if self.master is None:
+            return self.handle_message()
         
-        rsv = byte & 0x70
+        start = monotonic()
         
-        if rsv != 0:
-            raise Exception('error: RSV bit must be 0')
+        return self.master._handled(self.handle_message(), start)
     
-    def _header_b2(self, byte):
-        mask = byte & 0x80
-        length = byte & 0x7F
+    def _idle_timeout(self):
+        #======================================================================
+        # lastread is updated on every read rather than the timer being moved,
+        # so when it fires check how long it has really been.
+        #======================================================================
+        self.idletimer = None
         
-        if self.opcode == PING and length > 125:
-            raise Exception('error: ping packet is too large')
+        if self.closed is True or not self.idletimeout:
+            return
+        
+        idle = monotonic() - self.lastread
+        
+        if idle < self.idletimeout:
+            self.idletimer = self._start_timer(self.idletimeout - idle, self._idle_timeout)
+            return
         
-        if mask == 128:
-            self.hasmask = True
+        sys.stderr.write('error: idle timeout. Resource #%s\n' % self.fileno)
+        self.close(1001, u'idle timeout')
+    
+    def _inflate(self, data, compressed, final):
+        #======================================================================
+        # Decompress the payload of a frame that is part of a compressed
+        # message, final is True for the last frame of the message.
+        #======================================================================
+        if compressed is False:
+            return data
+        
+        return bytearray(self.deflate.decompress(data, final, self.maxpayload))
+    
+    def _parse_header(self, data, pos, size):
+        #======================================================================
+        # A header is between 2 and 14 bytes. If a previous recv ended part
+        # way through one the bytes read so far are held in headerpartial,
+        # otherwise we can read straight out of the receive buffer.
+        #======================================================================
+        held = len(self.headerpartial)
+        
+        if held > 0:
+            self.headerpartial.extend(data[pos:pos + 14 - held])
+            buf = self.headerpartial
+            start = 0
         else:
-            self.hasmask = False
+            buf = data
+            start = pos
+        
+        available = len(buf) - start
+        
+        if available < 2:
+            if held == 0:
+                self.headerpartial.extend(data[pos:size])
+            
+            return size
+        
+        b1, b2 = struct.unpack_from('!BB', buf, start)
+        opcode = b1 & 0x0F
+        
+        #======================================================================
+        # RSV1 marks a compressed message when permessage-deflate has been
+        # negotiated, it is only allowed on the first frame of a message.
+        #======================================================================
+        if b1 & 0x70 != 0:
+            if b1 & 0x70 != 0x40 or self.deflate is None or (opcode != TEXT and opcode != BINARY):
+                raise Exception('error: RSV bit must be 0')
         
-        if length <= 125:
-            self.length = length
+        length = b2 & 0x7F
+        hasmask = (b2 & 0x80) == 0x80
+        
+        if opcode == PING and length > 125:
+            raise Exception('error: ping packet is too large')
+        
+        needed = 2
+        
+        if length == 126:
+            needed += 2
+        elif length == 127:
+            needed += 8
+        
+        if hasmask:
+            needed += 4
+        
+        #======================================================================
+        # Not enough bytes for the whole header yet, so keep what we have
+        # and wait for the next recv.
+        #======================================================================
+        if available < needed:
+            if held == 0:
+                self.headerpartial.extend(data[pos:size])
             
+            return size
+        
+        offset = start + 2
+        
+        if length == 126:
+            length = struct.unpack_from('!H', buf, offset)[0]
+            offset += 2
+        elif length == 127:
+            length = struct.unpack_from('!Q', buf, offset)[0]
+            offset += 8
+        
+        if hasmask:
+            self.maskarray = bytearray(buf[offset:offset + 4])
+        else:
+            self.maskarray = None
+        
+        #======================================================================
+        # If length exceeds allowable size then we except and remove
+        # the connection.
+        #======================================================================
+        if length >= self.maxpayload:
+            raise Exception('error: payload exceeded allowable size')
+        
+        metrics = self.metrics
+        metrics.framesin[opcode] += 1
+        metrics.bytesin[opcode] += needed + length
+        
+        self.fin = b1 & 0x80
+        self.frame_opcode = opcode
+        self.frame_compressed = b1 & 0x40 == 0x40
+        self.frame_streamed = False
+        self.frame_spilled = False
+        self.hasmask = hasmask
+        self.length = length
+        self.index = 0
+        self.frame_data = bytearray()
+        
+        if held > 0:
+            consumed = pos + needed - held
+            self.headerpartial = bytearray()
+        else:
+            consumed = pos + needed
+        
+        if self.streaming and (opcode == TEXT or opcode == BINARY or opcode == STREAM):
+            self._stream_start()
+        else:
             #==================================================================
-            # If we have a mask we must read it.
+            # Checked before any of the frame is buffered or spilled, so a
+            # client can't grow a message without limit a frame at a time.
             #==================================================================
-            if self.hasmask is True:
-                self.maskarray = bytearray()
-                self.state = MASK
-            else:
-                #==============================================================
-                # If there is no mask and no payload we are done.
-                #==============================================================
-                if self.length <= 0:
-                    try:
-                        self._handle_packet()
-                    finally:
-                        self.state = HEADERB1
-                        self.data = bytearray()
-                #==============================================================
-                # We have no mask and some payload.
-                #==============================================================
+            if opcode == STREAM:
+                self.messagesize += length
+                
+                if self.messagesize > self.maxpayload:
+                    self.close(1009, u'message too big')
+                    raise Exception('error: message exceeded allowable size')
+            elif opcode == TEXT or opcode == BINARY:
+                self.messagesize = length
+            
+            self._spill_start()
+        
+        #======================================================================
+        # If there is no payload we are done.
+        #======================================================================
+        if length == 0:
+            try:
+                if self.frame_streamed:
+                    self._stream_chunk(b'', True)
                 else:
-                    self.data = bytearray()
-                    self.state = PAYLOAD
-        elif length == 126:
-            self.lengtharray = bytearray()
-            self.state = LENGTHSHORT
-        elif length == 127:
-            self.lengtharray == bytearray()
-            self.state = LENGTHLONG
-    
-    def _length_short(self, byte):
-        self.lengtharray.append(byte)
+                    self._handle_packet()
+            finally:
+                self.state = HEADERB1
+                self.frame_data = bytearray()
+        else:
+            self.state = PAYLOAD
         
-        if len(self.lengtharray) > 2:
-            raise Exception('error: short length exceeded allowable size')
+        return consumed
+    
+    def _parse_message(self, data):
+        #======================================================================
+        # Walk the receive buffer a frame at a time. Headers are decoded
+        # in one go and payloads are sliced out in bulk, a frame that
+        # continues past the end of the buffer is resumed on the next recv.
+        #======================================================================
+        pos = 0
+        size = len(data)
+        self.lastread = monotonic()
         
-        if len(self.lengtharray) == 2:
-            self.length = struct.unpack_from('!H', self.lengtharray)[0]
-            
-            if self.hasmask is True:
-                self.maskarray = bytearray()
-                self.state = MASK
+        while pos < size:
+            if self.state == PAYLOAD:
+                pos = self._payload(data, pos, size)
             else:
-                #==============================================================
-                # If there is no mask and no payload we are done.
-                #==============================================================
-                if self.length <= 0:
-                    try:
-                        self._handle_packet()
-                    finally:
-                        self.state = HEADERB1
-                        self.data = bytearray()
-                #==============================================================
-                # We have no mask and some payload.
-                #==============================================================
-                else:
-                    self.data = bytearray()
-                    self.state = PAYLOAD
+                pos = self._parse_header(data, pos, size)
     
-    def _length_long(self, byte):
-        self.lengtharray.append(byte)
+    def _keepalive(self):
+        #======================================================================
+        # Start the ping and idle timers. Dispatched after handle_connected so
+        # the intervals it sets are used, the timers are set from the server's
+        # event loop.
+        #======================================================================
+        if self.master is not None and self.master._off_loop():
+            self.master._call_soon(self._keepalive)
+            return
+        
+        if self.closed is True:
+            return
         
-        if len(self.lengtharray) > 8:
-            raise Exception('error: long length exceeded allowable size')
+        self.lastread = monotonic()
+        self.pingtimer = self._start_timer(self.pinginterval, self._ping)
+        self.idletimer = self._start_timer(self.idletimeout, self._idle_timeout)
+    
+    def _payload(self, data, pos, size):
+        end = min(size, pos + self.length - self.index)
         
-        if len(self.lengtharray) == 8:
-            self.length = struct.unpack_from('!Q', self.lengtharray)[0]
+        if self.frame_streamed:
+            #==================================================================
+            # Hand each slice on as soon as it is unmasked.
+            #==================================================================
+            if self.hasmask is True:
+                chunk = unmask(data[pos:end], self.maskarray, self.index)
+            else:
+                chunk = data[pos:end]
             
+            self.index += end - pos
+            
+            if self.index < self.length:
+                self._stream_chunk(chunk, False)
+                return end
+        elif self.frame_spilled:
             if self.hasmask is True:
-                self.maskarray = bytearray()
-                self.state = MASK
+                self.spill.write(unmask(data[pos:end], self.maskarray, self.index))
             else:
-                #==============================================================
-                # If there is no mask and no payload we are done.
-                #==============================================================
-                if self.length <= 0:
-                    try:
-                        self._handle_packet()
-                    finally:
-                        self.state = HEADERB1
-                        self.data = bytearray()
-                #==============================================================
-                # We have no mask and some payload.
-                #==============================================================
+                self.spill.write(data[pos:end])
+            self.index += end - pos
+        else:
+            if self.hasmask is True:
+                self.frame_data.extend(unmask(data[pos:end], self.maskarray, self.index))
+            else:
+                self.frame_data.extend(data[pos:end])
+            self.index += end - pos
+        
+        #======================================================================
+        # Check if we have processed length bytes. If so we are done.
+        #======================================================================
+        if self.index == self.length:
+            try:
+                if self.frame_streamed:
+                    self._stream_chunk(chunk, True)
                 else:
-                    self.data = bytearray()
-                    self.state = PAYLOAD
+                    self._handle_packet()
+            finally:
+                self.state = HEADERB1
+                self.frame_data = bytearray()
+        
+        return end
     
-    def _mask(self, byte):
-        self.maskarray.append(byte)
+    def _ping(self):
+        self.pingtimer = None
         
-        if len(self.maskarray) > 4:
-            raise Exception('error: mask exceeded allowable size')
+        if self.closed is True:
+            return
         
-        if len(self.maskarray) == 4:
-            #==================================================================
-            # If there is no mask and no payload we are done.
-            #==================================================================
-            if self.length <= 0:
-                try:
-                    self._handle_packet()
-                finally:
-                    self.state = HEADERB1
-                    self.data = bytearray()
+        self._send_ping()
+        self.pingtimer = self._start_timer(self.pinginterval, self._ping)
+    
+    def _queue(self, opcode, payload):
+        #======================================================================
+        # Let the server know when there is something to write so it only
+        # polls for writability while the sendq is non-empty.
+        #======================================================================
+        if isinstance(payload, _FileSegment):
             #==================================================================
-            # We have no mask and some payload.
+            # Nothing closes a segment queued after close(), e.g. by a
+            # handler that ran after the client went away, so let go of
+            # its descriptor now.
             #==================================================================
-            else:
-                self.data = bytearray()
-                self.state = PAYLOAD
-    
-    def _parse_message(self, byte):
-        #======================================================================
-        # Read in the header.
-        #======================================================================
-        if self.state == HEADERB1:
-            self._header_b1(byte)
-        elif self.state == HEADERB2:
-            self._header_b2(byte)
-        elif self.state == LENGTHSHORT:
-            self._length_short(byte)
-        elif self.state == LENGTHLONG:
-            self._length_long(byte)
-        elif self.state == MASK:
-            self._mask(byte)
-        elif self.state == PAYLOAD:
-            self._payload(byte)
-    
-    def _payload(self, byte):
-        if self.hasmask is True:
-            self.data.append(byte ^ self.maskarray[self.index % 4])
+            if self.closed is True:
+                payload.close()
+                return
+            
+            size = len(payload.header) + payload.remaining
         else:
-            self.data.append(byte)
+            size = len(payload)
+            self.sendqsize += size
         
         #======================================================================
-        # If length exceeds allowable size then we except and remove
-        # the connection.
+        # The upgrade response and HTTP errors aren't frames.
         #======================================================================
-        if len(self.data) >= self.maxpayload:
-            raise Exception('error: payload exceeded allowable size')
+        if self.handshaked:
+            metrics = self.metrics
+            metrics.framesout[opcode] += 1
+            metrics.bytesout[opcode] += size
         
-        #======================================================================
-        # Check if we have processed length bytes. If so we are done.
-        #======================================================================
-        if (self.index + 1) == self.length:
-            try:
-                self._handle_packet()
-            finally:
-                self.state = HEADERB1
-                self.data = bytearray()
+        if not self.sendq and self.master is not None:
+            self.sendq.append((opcode, payload))
+            self.master._want_write(self)
         else:
-            self.index += 1
+            self.sendq.append((opcode, payload))
+        
+        if self.throttled is False and self.sendqsize >= self.sendqhigh:
+            self._update_throttle()
     
-    def _send_buffer(self, buffer, sendall=False):
+    def _send_buffer(self, buffer, offset=0, sendall=False):
+        #======================================================================
+        # Send buffer from offset on. Returns None once it has all been sent
+        # or the offset reached so far if the socket would block, queued
+        # buffers may be shared between clients so they are never modified.
+        #
+        # The rest of the buffer is passed as a memoryview slice so a large
+        # frame isn't copied again on every partial write.
+        #======================================================================
         size = len(buffer)
-        tosend = size
-        already_sent = 0
+        view = memoryview(buffer)
         
-        while tosend > 0:
+        while offset < size:
             try:
-                #==============================================================
-                # We should be able to send bytearray.
-                #==============================================================
-                sent = self.sock.send(buffer[already_sent:])
+                sent = self.sock.send(view[offset:])
                 
                 if sent == 0:
                     raise RuntimeError('error: socket connection broken')
                 
-                already_sent += sent
-                tosend -= sent
+                offset += sent
             except socket.error as e:
                 #==============================================================
                 # If we have full buffers then wait for them to drain
                 # and try again.
                 #==============================================================
-                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                if _would_block(e):
                     if sendall:
                         continue;
-                    return buffer[already_sent:]
+                    return offset
                 else:
                     raise e
         
         return None
     
-    def _send_message(self, fin, opcode, data):
-        payload = bytearray();
+    def _send_queue(self):
+        #======================================================================
+        # Write out as much of the sendq as the socket will take. Only the
+        # frame at the head can be part sent, sendoffset is how much of it
+        # has gone.
+        #======================================================================
+        try:
+            if self.usesendmsg:
+                self._send_queue_gather()
+            else:
+                self._send_queue_single()
+        finally:
+            if self.throttled is True and self.sendqsize <= self.sendqlow:
+                self._update_throttle()
+    
+    def _send_queue_single(self):
+        while self.sendq:
+            opcode, payload = self.sendq[0]
+            
+            if isinstance(payload, _FileSegment):
+                if self._send_segment(payload) is False:
+                    break
+                
+                self.sendq.popleft()
+                continue
+            
+            offset = self._send_buffer(payload, self.sendoffset)
+            
+            if offset is not None:
+                self.sendqsize -= offset - self.sendoffset
+                self.sendoffset = offset
+                break
+            
+            self.sendq.popleft()
+            self.sendqsize -= len(payload) - self.sendoffset
+            self.sendoffset = 0
+            
+            if opcode == CLOSE:
+                raise Exception('info: received client close')
+    
+    def _send_queue_gather(self):
+        #======================================================================
+        # As _send_queue but hands runs of queued frames to a single
+        # sendmsg() call. A run stops at a CLOSE frame so nothing queued
+        # after it is sent.
+        #======================================================================
+        sendq = self.sendq
+        
+        while sendq:
+            if isinstance(sendq[0][1], _FileSegment):
+                if self._send_segment(sendq[0][1]) is False:
+                    return
+                
+                sendq.popleft()
+                continue
+            
+            buffers = []
+            total = 0
+            offset = self.sendoffset
+            
+            for opcode, payload in sendq:
+                if isinstance(payload, _FileSegment):
+                    break
+                
+                if offset > 0:
+                    buffers.append(memoryview(payload)[offset:])
+                    total += len(payload) - offset
+                    offset = 0
+                else:
+                    buffers.append(payload)
+                    total += len(payload)
+                
+                if opcode == CLOSE or len(buffers) >= SENDMSG_MAXIOV or total >= SENDMSG_MAXSIZE:
+                    break
+            
+            try:
+                sent = self.sock.sendmsg(buffers)
+            except socket.error as e:
+                if _would_block(e):
+                    return
+                
+                raise e
+            
+            if sent == 0:
+                raise RuntimeError('error: socket connection broken')
+            
+            self.sendqsize -= sent
+            
+            #==================================================================
+            # Drop the frames that went out whole, a write that ended part
+            # way through a frame leaves sendoffset pointing into it.
+            #==================================================================
+            left = sent
+            
+            while left > 0:
+                opcode, payload = sendq[0]
+                remaining = len(payload) - self.sendoffset
+                
+                if left < remaining:
+                    self.sendoffset += left
+                    break
+                
+                left -= remaining
+                sendq.popleft()
+                self.sendoffset = 0
+                
+                if opcode == CLOSE:
+                    raise Exception('info: received client close')
+            
+            #==================================================================
+            # A short write means the socket buffer is full.
+            #==================================================================
+            if sent < total:
+                return
+    
+    def _send_segment(self, segment):
+        #======================================================================
+        # Write as much of a send_file() message as the socket will take.
+        # Returns True once all of it has gone.
+        #======================================================================
+        size = len(segment.header)
+        
+        if segment.headersent < size:
+            offset = self._send_buffer(segment.header, segment.headersent)
+            
+            if offset is not None:
+                segment.headersent = offset
+                return False
+            
+            segment.headersent = size
+        
+        while segment.remaining > 0:
+            count = min(segment.remaining, SENDFILE_CHUNK)
+            
+            if self.usesendfile:
+                try:
+                    sent = os.sendfile(self.sock.fileno(), segment.fd, segment.offset, count)
+                except (OSError, socket.error) as e:
+                    if _would_block(e):
+                        return False
+                    
+                    raise e
+            else:
+                os.lseek(segment.fd, segment.offset, os.SEEK_SET)
+                data = os.read(segment.fd, count)
+                sent = len(data)
+                
+                if sent > 0:
+                    offset = self._send_buffer(data)
+                    
+                    if offset is not None:
+                        sent = offset
+                        
+                        if sent == 0:
+                            return False
+            
+            #==================================================================
+            # The frame header has promised the client count bytes, if the
+            # file is shorter all we can do is drop the connection.
+            #==================================================================
+            if sent == 0:
+                raise Exception('error: file ended before it could be sent')
+            
+            segment.offset += sent
+            segment.remaining -= sent
+            
+            if segment.remaining > 0 and sent < count:
+                return False
         
+        segment.close()
+        return True
+    
+    def _send_message(self, fin, opcode, data):
         b1 = 0
-        b2 = 0
         
         if fin is False:
             b1 |= 0x80
         
         b1 |= opcode
         
-        if _check_unicode(data):
-            data = data.encode('utf-8')
-        
-        length = len(data)
-        payload.append(b1)
-        
-        if length <= 255:
-            b2 |= length
-            payload.append(b2)
-        elif length >= 126 and length <= 65535:
-            b2 |= 126
-            payload.append(b2)
-            payload.extend(strunct.pack('!H', length))
-        else:
-            b2 |= 127
-            payload.append(b2)
-            payload.extend(struct.pack('!Q', length))
+        #======================================================================
+        # Compress data messages that are big enough to be worth it. The
+        # server can share the compressed frame of an immutable message with
+        # other clients and later sends of it, see _deflate_frame().
+        #======================================================================
+        if self.deflate is not None and (opcode == TEXT or opcode == BINARY):
+            key = None
+            
+            if _check_unicode(data):
+                key = (b1, data)
+                data = data.encode('utf-8')
+            elif isinstance(data, bytes):
+                key = (b1, data)
+            
+            if len(data) >= self.deflatethreshold:
+                if self.master is not None:
+                    self._queue(opcode, self.master._deflate_frame(self, b1, data, key))
+                else:
+                    self._queue(opcode, _encode_frame(b1 | 0x40, self.deflate.compress(bytes(data))))
+                
+                return
+        
+        self._queue(opcode, _encode_frame(b1, data))
+    
+    def _send_ping(self):
+        #======================================================================
+        # The payload is the time the PING was queued, the round trip is
+        # measured from then so it includes any wait in the sendq.
+        #======================================================================
+        if self.closed is True or self.handshaked is False:
+            return
+        
+        self.pingsent = monotonic()
+        self.pingpayload = struct.pack('!d', self.pingsent)
+        self._send_message(False, PING, self.pingpayload)
+    
+    def _spill_start(self):
+        #======================================================================
+        # Called with the header of each frame when not streaming. The
+        # payload of an uncompressed BINARY frame goes straight to the
+        # temporary file if the frame is over spillthreshold or is part of a
+        # message that has already been spilled.
+        #======================================================================
+        if self.spillthreshold is None or self.frame_compressed:
+            return
+        
+        if self.frame_opcode == BINARY and self.frag_start is False:
+            if self.length >= self.spillthreshold:
+                self.spill = tempfile.TemporaryFile()
+                self.frame_spilled = True
+        elif self.frame_opcode == STREAM and self.frag_start is True:
+            if self.spill is not None and self.frag_compressed is False:
+                self.frame_spilled = True
+    
+    def _spilled(self):
+        #======================================================================
+        # Map the spilled message read-only for the handler. The file itself
+        # is closed, the mapping lasts until the handler lets go of it.
+        #======================================================================
+        spill = self.spill
+        self.spill = None
+        
+        try:
+            spill.flush()
+            size = spill.tell()
+            
+            if size == 0:
+                return bytearray()
+            
+            return mmap.mmap(spill.fileno(), size, access=mmap.ACCESS_READ)
+        finally:
+            spill.close()
+    
+    def _start_timer(self, delay, func):
+        if self.master is None or not delay:
+            return None
+        
+        return self.master._schedule(delay, func)
+    
+    def _stream_chunk(self, data, last):
+        #======================================================================
+        # Pass on part of a streamed message, last is True for the end of a
+        # frame. TEXT is decoded as it goes so invalid UTF-8 is caught at the
+        # chunk it appears in.
+        #======================================================================
+        final = last and self.fin != 0
+        data = self._inflate(data, self.frag_compressed, final)
+        
+        if self.frag_type == TEXT:
+            try:
+                data = self.frag_decoder.decode(data, final=final)
+            except Exception as exp:
+                raise Exception('error: invalid utf-8 payload')
         
-        if length > 0:
-            payload.extend(data)
+        if data or final:
+            self._dispatch(partial(self.handle_message_chunk, data, final), self.frag_type, data)
+        
+        if final:
+            self._dispatch(self.handle_message_end, self.frag_type, None)
+            
+            self.frag_decoder.reset()
+            self.frag_type = BINARY
+            self.frag_start = False
+            self.frag_compressed = False
+    
+    def _stream_start(self):
+        #======================================================================
+        # Called with the header of each data frame when streaming. The
+        # first frame of a message starts it, continuation frames carry on
+        # the one in progress.
+        #======================================================================
+        if self.frame_opcode == STREAM:
+            if self.frag_start is False:
+                raise Exception('error: fragmentation protocol error')
+        else:
+            if self.frag_start is True:
+                raise Exception('error: fragmentation protocol error')
+            
+            self.frag_type = self.frame_opcode
+            self.frag_start = True
+            self.frag_compressed = self.frame_compressed
+            self.frag_decoder.reset()
+            
+            self._dispatch(self.handle_message_start, self.frag_type, None)
         
-        self.sendq.append((opcode, payload))
+        self.frame_streamed = True
+    
+    def _update_throttle(self):
+        #======================================================================
+        # Start or stop throttling when the sendq crosses a watermark. While
+        # throttled the server doesn't read from us.
+        #======================================================================
+        if self.throttled is False and self.sendqsize >= self.sendqhigh:
+            self.throttled = True
+            self.throttledsince = monotonic()
+            
+            if self.master is not None:
+                self.master._throttle(self, True)
+        elif self.throttled is True and self.sendqsize <= self.sendqlow:
+            self.throttled = False
+            self.throttledsince = None
+            
+            self._dispatch(self.handle_drain, self.opcode, self.data)
+            
+            if self.master is not None:
+                self.master._throttle(self, False)
     
     def close(self, status=1000, reason=u''):
         #======================================================================
@@ -600,6 +1521,10 @@ class WebSocket(object):
         # status is the closing identifier.
         # reason is the reason for the close.
         #======================================================================
+        if self.master is not None and self.master._off_loop():
+            self.master._call_soon(partial(self.close, status, reason))
+            return
+        
         try:
             if self.closed is False:
                 close_msg = bytearray()
@@ -611,22 +1536,36 @@ class WebSocket(object):
                     close_msg.extend(reason)
                 
                 self._send_message(False, CLOSE, close_msg)
+                self._send_queue()
                 
-                while self.sendq:
-                    opcode, payload = self.sendq.popleft()
-                    remaining = self._send_buffer(payload)
-                    
-                    if remaining is not None:
-                        self.sendq.appendleft((opcode, remaining))
-                        break
-                    else:
-                        if opcode == CLOSE:
-                            raise Exception('info: received client close')
+                #==============================================================
+                # The close frame is stuck behind data the client hasn't read
+                # yet. Stop reading and give it closetimeout to go out, the
+                # server calls us again once it has.
+                #==============================================================
+                if self.sendq and self.handshaked and self.closetimeout and self.master is not None:
+                    self.closed = True
+                    self.closetimer = self._start_timer(self.closetimeout, self._close_timeout)
+                    self.master._want_write(self)
+                    return
         except Exception as ex:
             sys.stderr.write('%s\n' % str(ex))    
         finally:
             self.closed = True
         
+        self._cancel_timers()
+        
+        if self.master is not None:
+            self.master._discard(self)
+        
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        
+        for opcode, payload in self.sendq:
+            if isinstance(payload, _FileSegment):
+                payload.close()
+        
         try:
             self.sock.close()
         except Exception as ex:
@@ -638,7 +1577,23 @@ class WebSocket(object):
         # If we have a successful websocket connection.
         #======================================================================
         if self.handshaked:
-            self.handle_close()
+            self._dispatch(self.handle_close, self.opcode, self.data)
+    
+    @property
+    def request(self):
+        #======================================================================
+        # The upgrade request as a BaseHTTPRequestHandler, which is costly to
+        # build so it is only parsed if something asks for it. self.headers
+        # has the headers the handshake uses.
+        #======================================================================
+        if self._request is None and self.handshaked:
+            self._request = HTTPRequest(bytes(self.headerbuffer))
+        
+        return self._request
+    
+    @request.setter
+    def request(self, request):
+        self._request = request
     
     def handle_close(self):
         pass
@@ -646,19 +1601,105 @@ class WebSocket(object):
     def handle_connected(self):
         pass
     
+    def handle_drain(self):
+        pass
+    
     def handle_message(self):
         pass
     
+    def handle_message_chunk(self, data, final):
+        pass
+    
+    def handle_message_end(self):
+        pass
+    
+    def handle_message_start(self):
+        pass
+    
+    def ping(self):
+        #======================================================================
+        # Send a PING now rather than waiting for pinginterval, rtt is updated
+        # when the PONG arrives.
+        #======================================================================
+        self._call(self._send_ping)
+    
+    def publish(self, topic, data, exclude=None):
+        #======================================================================
+        # Send data to every client subscribed to topic, see subscribe().
+        #======================================================================
+        self._call(self.master.publish, topic, data, exclude)
+    
     def send_message(self, data):
         #======================================================================
         # Send websocket data frame to the client.
         #
         # If data is a unicode object then the frame is sent as TEXT.
         # If the data is a bytearray object then the frame is sent as BINARY
+        #
+        # The message is always queued. Returns False when the client has
+        # more than sendqhigh bytes waiting, callers should hold off sending
+        # until handle_drain() is called.
         #======================================================================
         opcode = BINARY
         
         if _check_unicode(data):
             opcode = TEXT
         
-        self._send_message(False, opcode, data)
\ No newline at end of file
+        self._call(self._send_message, False, opcode, data)
+        
+        return self.throttled is False
+    
+    def send_file(self, file, offset=0, count=None):
+        #======================================================================
+        # Send count bytes of a file from offset as a BINARY message without
+        # reading it into memory, count defaults to the rest of the file. The
+        # message is queued in order with send_message() and the file data
+        # is sent from the server's event loop with os.sendfile() where it
+        # is available.
+        #
+        # file is a path, a file descriptor or an object with fileno(). We
+        # keep our own descriptor so the caller can close theirs straight
+        # away.
+        #
+        # Returns the same as send_message(), the file data itself doesn't
+        # count towards sendqhigh. Does nothing once the client is closed.
+        #======================================================================
+        if self.closed is True:
+            return False
+        
+        if isinstance(file, int):
+            fd = os.dup(file)
+        elif hasattr(file, 'fileno'):
+            fd = os.dup(file.fileno())
+        else:
+            fd = os.open(file, os.O_RDONLY)
+        
+        try:
+            size = os.fstat(fd).st_size
+            
+            if count is None:
+                count = size - offset
+            
+            #==================================================================
+            # The frame header promises count bytes, so they must all be
+            # there to send.
+            #==================================================================
+            if offset < 0 or count < 0 or offset + count > size:
+                raise ValueError('error: invalid offset or count')
+        except Exception:
+            os.close(fd)
+            raise
+        
+        self._call(self._queue, BINARY, _FileSegment(fd, offset, count))
+        
+        return self.throttled is False
+    
+    def subscribe(self, topic):
+        #======================================================================
+        # Receive messages published to topic (a string). Subscriptions are
+        # dropped automatically when the connection is closed.
+        #======================================================================
+        self._call(self.master._subscribe, self, topic)
+    
+    def unsubscribe(self, topic):
+        self._call(self.master._unsubscribe, self, topic)
\ No newline at end of file
@@ -22,155 +22,979 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-from    .websocket      import  *
-from    select          import  select
+from    .broadcastbus       import  ALL, TOPIC
+from    .histogram          import  DURATION_BUCKETS, RTT_BUCKETS, Histogram
+from    .metrics            import  Metrics
+from    .permessagedeflate  import  DeflateCache
+from    .poller             import  DefaultPoller, READ, WRITE
+from    .processpool        import  ProcessPool, ProcessPoolExecutor
+from    .timerwheel         import  TimerWheel, monotonic
+from    .websocket          import  *
+from    .websocket          import  _check_unicode, _encode_frame
+from    collections         import  deque
+from    functools           import  partial
 
+import  errno
 import  os
 import  re
 import  socket
+import  struct
 import  sys
+import  threading
 
-class WebSocketServer(object):
-    def __init__(self, host, port, ssl_context=None, websocketclass=WebSocket):
+try:
+    from    concurrent.futures  import  ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+try:
+    import  ssl
+    
+    from    .tlsconfig  import  TLSConfig
+except ImportError:
+    ssl = None
+    TLSConfig = None
+
+#==========================================================================
+# How often throttled clients are checked against their slow consumer
+# policy, in seconds.
+#==========================================================================
+CHECK_INTERVAL  = 1.0
+
+#==========================================================================
+# Clients get this many seconds to complete the TLS handshake.
+#==========================================================================
+TLS_HANDSHAKE_TIMEOUT = 10.0
+
+#==========================================================================
+# The most connections taken from the listen backlog each time the master
+# socket is readable, so a flood of them can't starve connected clients.
+#==========================================================================
+ACCEPT_BUDGET   = 64
+
+#==========================================================================
+# When we run out of file descriptors the master socket is left out of
+# the poller for this many seconds, rather than reporting the same waiting
+# connection as readable on every pass.
+#==========================================================================
+ACCEPT_RETRY_DELAY = 0.5
+
+def _somaxconn():
+    #======================================================================
+    # The kernel caps the listen backlog at net.core.somaxconn, which can
+    # be a lot higher than socket.SOMAXCONN.
+    #======================================================================
+    try:
+        with open('/proc/sys/net/core/somaxconn') as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return socket.SOMAXCONN
+
+BACKLOG         = _somaxconn()
+
+#==========================================================================
+# When handlers run on a thread pool, the most handler calls queued on the
+# pool at once across all clients.
+#==========================================================================
+MAX_INFLIGHT    = 1024
+
+def _frame_payload(frame):
+    #======================================================================
+    # The payload of an unmasked frame built by _encode_frame().
+    #======================================================================
+    length = struct.unpack_from('!BB', frame)[1]
+    
+    if length == 126:
+        return frame[4:]
+    elif length == 127:
+        return frame[10:]
+    
+    return frame[2:]
+
+def _load_websocketclass(websocketclass):
+    #======================================================================
+    # websocketclass is either a WebSocket subclass or a 'file:class'
+    # string naming one, anything we can't load falls back to WebSocket.
+    #======================================================================
+    if isinstance(websocketclass, type):
+        return websocketclass
+    
+    match = re.compile('(.*):(.*)')
+    match = match.search(websocketclass)
+    
+    if match is not None and len(match.groups()) == 2:
         try:
-            self.master = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.master.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.master.bind((host, port))
-            self.master.listen(5)
-            sys.stdout.write('Server started\nListening on: %s:%s\nMaster socket: Resource #%s\n'
-                % (host, port, self.master.fileno()))
+            module_dir, module_file = os.path.split(match.group(1))
+            sys.path.append(module_dir)
+            
+            module_name, module_ext = os.path.splitext(module_file)
+            mod = __import__(module_name, globals(), locals(), match.group(2))
+            
+            return getattr(mod, match.group(2))
         except Exception as ex:
-            self.master.close()
             sys.stderr.write('%s\n' % str(ex))
+    
+    return WebSocket
+
+def _listen(host, port, reuse_port=False, backlog=BACKLOG):
+    #======================================================================
+    # With reuse_port several processes can each bind their own socket to
+    # the same address and the kernel spreads connections between them.
+    # backlog is how many connections the kernel queues for us, once it's
+    # full new clients have their SYNs dropped and retry after a second or
+    # more.
+    #======================================================================
+    master = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    
+    try:
+        master.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        
+        if reuse_port:
+            master.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        
+        master.bind((host, port))
+        master.listen(backlog)
+    except Exception:
+        master.close()
+        raise
+    
+    return master
+
+class _BaseWebSocketServer(object):
+    #======================================================================
+    # Client fan-out shared by WebSocketServer and AsyncWebSocketServer.
+    # Subclasses provide socks, topics, bus, deflatecache and
+    # _bus_want_write(), _bus_close() and _throttle() for their event loop.
+    #
+    # topics maps each topic to the set of clients subscribed to it and
+    # every WebSocket keeps the set of topics it is subscribed to, so
+    # subscribing and unsubscribing are O(1) and publishing only touches
+    # the subscribers.
+    #======================================================================
+    deflate = False
+    
+    def _off_loop(self):
+        #==================================================================
+        # True when called from a thread other than the event loop's, see
+        # WebSocketServer's threads.
+        #==================================================================
+        return False
+    
+    def _queued(self, websocket):
+        #==================================================================
+        # Called when a handler call is added to websocket's inbox.
+        #==================================================================
+        pass
+    
+    def _handled(self, result, start):
+        #==================================================================
+        # Called by WebSocket with what handle_message returned and the
+        # time it was called.
+        #==================================================================
+        self.metrics.handler.observe(monotonic() - start)
+        
+        return result
+    
+    def _init_metrics(self, metricspath):
+        #==================================================================
+        # The gauges are only worked out when the metrics are asked for.
+        # A plain GET of metricspath is answered with them, see
+        # WebSocket._do_handshake().
+        #==================================================================
+        self.metricspath = metricspath
+        self.metrics = metrics = Metrics()
+        
+        #==================================================================
+        # Round trip times of every client's PINGs.
+        #==================================================================
+        self.latency = Histogram(RTT_BUCKETS)
+        
+        metrics.add('websocket_open_connections', 'gauge', 'Connections open.',
+            lambda: len(self.socks))
+        metrics.add('websocket_sendq_bytes', 'gauge', 'Bytes waiting in the sendq of every client.',
+            lambda: sum(websocket.sendqsize for websocket in list(self.socks.values())))
+        metrics.add('websocket_rtt_seconds', 'histogram', 'Round trip times of PINGs.',
+            self.latency)
+        metrics.add('websocket_tls_full_handshakes_total', 'counter', 'Full TLS handshakes.',
+            lambda: self.tls.full if self.tls is not None else None)
+        metrics.add('websocket_tls_resumed_handshakes_total', 'counter',
+            'TLS handshakes resuming a session.',
+            lambda: self.tls.resumed if self.tls is not None else None)
+        metrics.add('websocket_deflate_cache_hits_total', 'counter',
+            'Broadcast frames found already compressed.', lambda: self.deflatecache.hits)
+        metrics.add('websocket_deflate_cache_misses_total', 'counter',
+            'Broadcast frames that had to be compressed.', lambda: self.deflatecache.misses)
+    
+    def _process(self, websocket, data):
+        #==================================================================
+        # Without a process pool the processhandler is called right here.
+        #==================================================================
+        result = websocket.processhandler(data)
+        
+        if result is not None:
+            websocket.send_message(result)
+    
+    def _process_pool(self, processes):
+        if processes <= 0:
+            return None
+        
+        if ProcessPoolExecutor is None:
+            sys.stderr.write('error: handler processes need concurrent.futures\n')
             sys.exit(2)
         
-        self.ssl_context = ssl_context
-        self.socks = {}
-        self.listeners = [self.master]
+        return ProcessPool(processes)
+    
+    def _reply(self, websocket, future):
+        try:
+            result = self.processpool.result(future)
+        except Exception as ex:
+            sys.stderr.write('error: process handler failed: %s\n' % str(ex))
+            websocket.close(1011, u'internal error')
+            return
         
-        match = re.compile('(.*):(.*)')
-        match = match.search(websocketclass)
+        if result is not None and websocket.closed is False:
+            websocket.send_message(result)
+    
+    def _replies(self, websocket):
+        #==================================================================
+        # Send the replies that are ready, stopping at the first one that
+        # isn't so they go out in order.
+        #==================================================================
+        replies = websocket.replies
         
-        if match is not None and len(match.groups()) == 2:
-            #print match.group(1)
-            try:
-                module_dir, module_file = os.path.split(match.group(1))
-                sys.path.append(module_dir)
-                
-                module_name, module_ext = os.path.splitext(module_file)
-                mod = __import__(module_name, globals(), locals(), match.group(2))
+        while replies and replies[0].done():
+            self._reply(websocket, replies.popleft())
+    
+    def _bus_read(self):
+        if self.bus is None:
+            return
+        
+        try:
+            messages = self.bus.receive()
+        except Exception as ex:
+            sys.stderr.write('%s\n' % str(ex))
+            self._bus_close()
+            return
+        
+        for kind, channel, frame in messages:
+            if kind == ALL:
+                self._deliver_frame(frame)
+            elif kind == TOPIC:
+                subscribers = self.topics.get(channel)
                 
-                self.websocketclass = getattr(mod, match.group(2))
-            except Exception as ex:
-                sys.stderr.write('%s\n' % str(ex))
-                self.websocketclass = WebSocket
+                if subscribers:
+                    self._deliver_frame(frame, subscribers)
+    
+    def _bus_write(self):
+        if self.bus is None:
+            return
+        
+        try:
+            if self.bus.write():
+                self._bus_want_write(False)
+        except Exception as ex:
+            sys.stderr.write('%s\n' % str(ex))
+            self._bus_close()
+    
+    def _deflate_frame(self, websocket, b1, data, key=None):
+        #==================================================================
+        # Build a compressed frame of data for websocket. When it was
+        # negotiated without context takeover and key identifies the
+        # message, the frame comes from or goes into deflatecache so other
+        # connections with the same parameters, and later sends of the same
+        # message, skip the compression.
+        #==================================================================
+        params = websocket.deflate.cachekey()
+        
+        if params is None or key is None:
+            return _encode_frame(b1 | 0x40, websocket.deflate.compress(data))
+        
+        key = (key, params)
+        frame = self.deflatecache.get(key)
+        
+        if frame is None:
+            frame = _encode_frame(b1 | 0x40, websocket.deflate.compress(data))
+            self.deflatecache.put(key, frame, len(data) + len(frame))
+        
+        return frame
+    
+    def _set_ssl_context(self, ssl_context):
+        #==================================================================
+        # ssl_context is an SSLContext or a TLSConfig, which replaces its
+        # context now and then and counts resumed handshakes.
+        #==================================================================
+        if TLSConfig is not None and isinstance(ssl_context, TLSConfig):
+            self.tls = ssl_context
+            self.ssl_context = ssl_context.context
         else:
-            self.websocketclass = WebSocket
+            self.tls = None
+            self.ssl_context = ssl_context
     
-    def _construct_websocket(self, sock, address):
-        return self.websocketclass(self, sock, address)
+    def _deliver_frame(self, frame, targets=None, exclude=None):
+        #==================================================================
+        # Queue an uncompressed frame to targets. Clients that negotiated
+        # permessage-deflate get a compressed copy when the message is big
+        # enough, the frame itself is the cache key.
+        #==================================================================
+        b1 = struct.unpack_from('!B', frame)[0]
+        opcode = b1 & 0x0F
+        payload = None
+        
+        if targets is None:
+            targets = self.socks.values()
+        
+        for websocket in targets:
+            if websocket.handshaked is False or websocket.closed is True or websocket is exclude:
+                continue
+            
+            if websocket.deflate is None or (opcode != TEXT and opcode != BINARY):
+                websocket._queue(opcode, frame)
+                continue
+            
+            if payload is None:
+                payload = _frame_payload(frame)
+            
+            if len(payload) < websocket.deflatethreshold:
+                websocket._queue(opcode, frame)
+            else:
+                websocket._queue(opcode, self._deflate_frame(websocket, b1, payload, frame))
     
-    def _failed(self, socks):
-        for fileno in socks:
-            if fileno == self.master:
-                self.close();
-                sys.stderr.write('error: master socket failed\n')
+    def _subscribe(self, websocket, topic):
+        subscribers = self.topics.get(topic)
+        
+        if subscribers is None:
+            subscribers = self.topics[topic] = set()
+        
+        subscribers.add(websocket)
+        websocket.topics.add(topic)
+    
+    def _unsubscribe(self, websocket, topic):
+        subscribers = self.topics.get(topic)
+        
+        if subscribers is not None:
+            subscribers.discard(websocket)
+            
+            if not subscribers:
+                del self.topics[topic]
+        
+        websocket.topics.discard(topic)
+    
+    def _unsubscribe_all(self, websocket):
+        for topic in list(websocket.topics):
+            self._unsubscribe(websocket, topic)
+    
+    def broadcast(self, data, targets=None, exclude=None):
+        #==================================================================
+        # Send data to many clients at once. The frame is encoded once into
+        # an immutable buffer and that same buffer is queued for every
+        # client, each client's sendoffset tracks how much of it has gone.
+        #
+        # targets is an iterable of WebSockets on this server, when it is
+        # None the message goes to every connected client, in every worker
+        # when running with --workers.
+        #
+        # exclude is a WebSocket to leave out, usually the sender.
+        #==================================================================
+        if self._off_loop():
+            self._call_soon(partial(self.broadcast, data, targets, exclude))
+            return
+        
+        opcode = BINARY
+        
+        if _check_unicode(data):
+            opcode = TEXT
+        
+        frame = _encode_frame(0x80 | opcode, data)
+        self._deliver_frame(frame, targets, exclude)
+        
+        if targets is None and self.bus is not None and self.bus.publish(ALL, u'', frame):
+            self._bus_want_write(True)
+    
+    def publish(self, topic, data, exclude=None):
+        #==================================================================
+        # Send data to every client subscribed to topic, in every worker
+        # when running with --workers. Like broadcast() the frame is only
+        # encoded once.
+        #
+        # exclude is a WebSocket to leave out, usually the sender.
+        #==================================================================
+        if self._off_loop():
+            self._call_soon(partial(self.publish, topic, data, exclude))
+            return
+        
+        opcode = BINARY
+        
+        if _check_unicode(data):
+            opcode = TEXT
+        
+        frame = _encode_frame(0x80 | opcode, data)
+        subscribers = self.topics.get(topic)
+        
+        if subscribers:
+            self._deliver_frame(frame, subscribers, exclude)
+        
+        if self.bus is not None and self.bus.publish(TOPIC, topic, frame):
+            self._bus_want_write(True)
+
+class WebSocketServer(_BaseWebSocketServer):
+    def __init__(self, host, port, ssl_context=None, websocketclass=WebSocket, poller=None,
+            reuse_port=False, master=None, bus=None, deflate=False, backlog=BACKLOG,
+            threads=0, maxinflight=MAX_INFLIGHT, processes=0, metricspath=None):
+        #==================================================================
+        # A listening socket can be passed in as master, e.g. one inherited
+        # from a supervisor process, otherwise we bind our own.
+        #==================================================================
+        try:
+            if master is None:
+                master = _listen(host, port, reuse_port, backlog)
+            
+            #==============================================================
+            # Non-blocking so _accept() can take connections until there
+            # are none left, and so workers sharing master don't block in
+            # accept() when another worker got there first.
+            #==============================================================
+            master.setblocking(0)
+            
+            self.master = master
+            sys.stdout.write('Server started\nListening on: %s:%s\nMaster socket: Resource #%s\n'
+                % (host, port, self.master.fileno()))
+        except Exception as ex:
+            sys.stderr.write('%s\n' % str(ex))
+            sys.exit(2)
+        
+        self._set_ssl_context(ssl_context)
+        self.socks = {}
+        self.topics = {}
+        
+        #==================================================================
+        # Every timeout runs off one timer wheel, the poller sleeps until
+        # the next one is due. Throttled clients map to the timer of their
+        # next slow consumer check.
+        #==================================================================
+        self.timers = TimerWheel()
+        self.throttled = {}
+        
+        self._init_metrics(metricspath)
+        self.metrics.loop = self.metrics.add('websocket_loop_iteration_seconds', 'histogram',
+            'Time spent handling the events of one pass of the server loop.',
+            Histogram(DURATION_BUCKETS))
+        
+        #==================================================================
+        # Handlers on the thread pool record how long they took from their
+        # own threads.
+        #==================================================================
+        self.metricslock = threading.Lock()
+        
+        #==================================================================
+        # Clients still doing the TLS handshake, with the timer for its
+        # deadline. They only become WebSockets reading the upgrade request
+        # once it's done.
+        #==================================================================
+        self.handshaking = {}
+        
+        #==================================================================
+        # Offer permessage-deflate to clients that ask for it.
+        #==================================================================
+        self.deflate = deflate
+        self.deflatecache = DeflateCache()
+        
+        #==================================================================
+        # Sockets stay registered with the poller for their lifetime, only
+        # write interest is switched on and off as their sendq fills and
+        # empties.
+        #==================================================================
+        self.poller = poller if poller is not None else DefaultPoller()
+        self.master_fileno = self.master.fileno()
+        self.poller.register(self.master_fileno, READ)
+        
+        #==================================================================
+        # Link to the other workers for broadcast(), see broadcastbus.
+        #==================================================================
+        self.bus = bus
+        self.bus_fileno = None
+        
+        if bus is not None:
+            self.bus_fileno = bus.fileno()
+            self.poller.register(self.bus_fileno, READ)
+        
+        #==================================================================
+        # With threads handlers run on a pool of that many threads, one
+        # call at a time per client so each client's messages are still
+        # handled in order. Anything a handler does to a client or the
+        # server is passed back to this thread through calls and the
+        # wakeup pipe, as are the results of processhandlers run on the
+        # pool of processes.
+        #==================================================================
+        self.executor = None
+        self.loopthread = threading.current_thread()
+        self.calls = deque()
+        self.wakeup_fileno = None
+        self.maxinflight = maxinflight
+        self.inflight = 0
+        self.running = {}
+        self.waiting = deque()
+        self.waitingset = set()
+        self.paused = set()
+        self.processpool = self._process_pool(processes)
+        
+        if threads > 0:
+            if ThreadPoolExecutor is None:
+                sys.stderr.write('error: handler threads need concurrent.futures\n')
                 sys.exit(2)
             
-            if fileno not in self.socks:
-                continue
+            self.executor = ThreadPoolExecutor(threads)
+        
+        if self.executor is not None or self.processpool is not None:
+            self.wakeup_fileno, self.wakeup_write = os.pipe()
             
-            sock = self.sockets[fileno]
-            sock.close()
+            for fd in [self.wakeup_fileno, self.wakeup_write]:
+                if hasattr(os, 'set_blocking'):
+                    os.set_blocking(fd, False)
+                else:
+                    import  fcntl
+                    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
             
+            self.poller.register(self.wakeup_fileno, READ)
+        
+        self.websocketclass = _load_websocketclass(websocketclass)
+    
+    def _bus_close(self):
+        self.poller.unregister(self.bus_fileno)
+        self.bus.close()
+        self.bus = None
+        self.bus_fileno = None
+    
+    def _bus_want_write(self, want):
+        self.poller.modify(self.bus_fileno, (READ | WRITE) if want else READ)
+    
+    def _call_soon(self, func):
+        #==================================================================
+        # Have the event loop call func, from any thread.
+        #==================================================================
+        self.calls.append(func)
+        
+        try:
+            os.write(self.wakeup_write, b'\0')
+        except OSError as e:
+            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                raise
+    
+    def _construct_websocket(self, sock, address):
+        websocket = self.websocketclass(self, sock, address)
+        
+        if self.executor is not None:
+            websocket.inbox = deque()
+        
+        return websocket
+    
+    def _discard(self, websocket):
+        #==================================================================
+        # Called by WebSocket.close() so the socket is dropped whether it
+        # was closed by us or by a handler.
+        #==================================================================
+        fileno = websocket.fileno
+        
+        if self.socks.get(fileno) is websocket:
             del self.socks[fileno]
-            self.listeners.remove(fileno)
+            self.poller.unregister(fileno)
+        
+        for timer in [self.throttled.pop(websocket, None), self.handshaking.pop(websocket, None)]:
+            if timer is not None:
+                timer.cancel()
+        
+        self.paused.discard(websocket)
+        self._unsubscribe_all(websocket)
+    
+    def _accept(self):
+        #==================================================================
+        # Take the connections waiting in the backlog, up to ACCEPT_BUDGET
+        # of them. The poller says the master socket is still readable if
+        # any are left.
+        #==================================================================
+        connected = []
+        
+        if self.tls is not None:
+            self.ssl_context = self.tls.current()
+        
+        for _ in range(ACCEPT_BUDGET):
+            sock = None
+            
+            try:
+                sock, address = self.master.accept()
+            except socket.error as e:
+                if e.errno == errno.ECONNABORTED:
+                    continue
+                
+                if e.errno in [errno.EMFILE, errno.ENFILE]:
+                    sys.stderr.write('%s, not accepting for %s seconds\n'
+                        % (str(e), ACCEPT_RETRY_DELAY))
+                    self.poller.modify(self.master_fileno, 0)
+                    self._schedule(ACCEPT_RETRY_DELAY, self._resume_accept)
+                elif e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    sys.stderr.write('%s\n' % str(e))
+                
+                break
+            
+            try:
+                sock.setblocking(0)
+                
+                #==========================================================
+                # The TLS handshake is driven by the poller like
+                # everything else, see _tls_handshake().
+                #==========================================================
+                if self.ssl_context is not None:
+                    sock = self.ssl_context.wrap_socket(sock, server_side=True,
+                        do_handshake_on_connect=False)
+                
+                fileno = sock.fileno()
+                websocket = self._construct_websocket(sock, address)
+                
+                self.socks[fileno] = websocket
+                self.poller.register(fileno, READ)
+                self.metrics.connections.value += 1
+                
+                #==========================================================
+                # The TLS handshake has its own timeout, handshaketimeout
+                # starts once it is done.
+                #==========================================================
+                if self.ssl_context is not None:
+                    self.handshaking[websocket] = self._schedule(TLS_HANDSHAKE_TIMEOUT,
+                        self._tls_timeout, websocket)
+                else:
+                    websocket._accepted()
+                
+                connected.append('Client connected. Resource #%s\n' % fileno)
+            except Exception as ex:
+                sys.stderr.write('%s\n' % str(ex))
+                sock.close()
+        
+        #==================================================================
+        # One write for the lot rather than one per connection.
+        #==================================================================
+        if connected:
+            sys.stdout.write(''.join(connected))
     
     def _ready(self, socks):
         for fileno in socks:
-            if fileno == self.master:
-                sock = None
-                
-                try:
-                    sock, address = self.master.accept();
-                    
-                    if self.ssl_context is not None:
-                        sock = self.ssl_context.wrap_socket(sock, server_side=True)
-                    
-                    sock.setblocking(0)
-                    fileno = sock.fileno()
-                    
-                    self.socks[fileno] = self._construct_websocket(sock, address)
-                    self.listeners.append(fileno)
-                    
-                    sys.stdout.write('Client connected. Resource #%s\n' % fileno)
-                except Exception as ex:
-                    sys.stderr.write('%s\n' % str(ex))
-                    if sock is not None:
-                        sock.close()
+            if fileno == self.master_fileno:
+                self._accept()
             else:
                 if fileno not in self.socks:
                     continue
                 
                 sock = self.socks[fileno]
                 
+                if sock in self.handshaking:
+                    self._tls_handshake(fileno, sock)
+                    continue
+                
                 try:
                     sock._handle_data()
                 except Exception as ex:
                     sys.stderr.write('%s\n' % str(ex))
-                    sock.close()
                     
-                    del self.socks[fileno]
-                    self.listeners.remove(fileno)
+                    if sock.closed is False:
+                        sock.close()
+    
+    def _resume_accept(self):
+        self.poller.modify(self.master_fileno, READ)
     
     def _run(self):
+        readers = []
         writers = []
         
-        for fileno in self.listeners:
-            if fileno == self.master:
+        #==================================================================
+        # Sleep until the next timer is due at the latest.
+        #==================================================================
+        ready = self.poller.poll(self.timers.timeout())
+        start = monotonic()
+        
+        for fileno, events in ready:
+            if fileno == self.wakeup_fileno:
+                self._wakeup()
                 continue
             
-            sock = self.socks[fileno]
+            if fileno == self.bus_fileno:
+                if events & WRITE:
+                    self._bus_write()
+                
+                if events & READ:
+                    self._bus_read()
+                
+                continue
             
-            if sock.sendq:
+            if events & WRITE:
                 writers.append(fileno)
-        
-        ready, writers, failed = select(self.listeners, writers, self.listeners)
+            
+            if events & READ:
+                readers.append(fileno)
         
         self._writers(writers)
-        self._ready(ready)
-        self._failed(failed)
+        self._ready(readers)
+        self.timers.advance()
+        self.metrics.loop.observe(monotonic() - start)
+    
+    def _check_throttled(self, websocket):
+        #==================================================================
+        # Runs every CHECK_INTERVAL seconds while websocket is throttled.
+        #==================================================================
+        if websocket not in self.throttled:
+            return
+        
+        websocket._check_slow_consumer()
+        
+        if websocket in self.throttled:
+            self.throttled[websocket] = self._schedule(CHECK_INTERVAL, self._check_throttled, websocket)
+    
+    def _batch_done(self, websocket, count):
+        #==================================================================
+        # A pool thread has run count of websocket's handler calls. Send
+        # the next batch for it, or for clients waiting for room on the
+        # pool, and read from it again if we had stopped.
+        #==================================================================
+        self.inflight -= count
+        del self.running[websocket]
+        
+        if websocket.inbox:
+            self._queued(websocket)
+        
+        if websocket in self.paused and len(websocket.inbox) < websocket.handlerqueue:
+            self.paused.discard(websocket)
+            self._update_interest(websocket)
+        
+        while self.waiting and self.inflight < self.maxinflight:
+            waiting = self.waiting.popleft()
+            self.waitingset.discard(waiting)
+            
+            if waiting.inbox and waiting not in self.running:
+                self._submit(waiting)
+    
+    def _run_batch(self, websocket, batch):
+        #==================================================================
+        # Runs on a pool thread.
+        #==================================================================
+        for handler, websocket.opcode, websocket.data in batch:
+            try:
+                handler()
+            except Exception as ex:
+                sys.stderr.write('%s\n' % str(ex))
+                
+                if websocket.closed is False:
+                    websocket.close()
+        
+        self._call_soon(partial(self._batch_done, websocket, len(batch)))
+    
+    def _handled(self, result, start):
+        if not self._off_loop():
+            return _BaseWebSocketServer._handled(self, result, start)
+        
+        with self.metricslock:
+            return _BaseWebSocketServer._handled(self, result, start)
+    
+    def _process(self, websocket, data):
+        #==================================================================
+        # Start the processhandler on the pool. Replies are sent in the
+        # order the messages came in, whichever worker finishes first.
+        #==================================================================
+        if self.processpool is None:
+            return _BaseWebSocketServer._process(self, websocket, data)
+        
+        if self._off_loop():
+            self._call_soon(partial(self._process, websocket, data))
+            return
+        
+        future = self.processpool.submit(websocket.processhandler, data, _check_unicode(data))
+        websocket.replies.append(future)
+        future.add_done_callback(lambda future: self._call_soon(partial(self._replies, websocket)))
+    
+    def _submit(self, websocket):
+        batch = list(websocket.inbox)
+        websocket.inbox.clear()
+        
+        self.inflight += len(batch)
+        self.running[websocket] = len(batch)
+        self.executor.submit(self._run_batch, websocket, batch)
+    
+    def _wakeup(self):
+        try:
+            while os.read(self.wakeup_fileno, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                raise
+        
+        calls = self.calls
+        
+        while calls:
+            func = calls.popleft()
+            
+            try:
+                func()
+            except Exception as ex:
+                sys.stderr.write('%s\n' % str(ex))
+    
+    def _abort(self, websocket):
+        #==================================================================
+        # Close a connection that never got as far as TLS, there's no way
+        # to send it a close frame.
+        #==================================================================
+        websocket.closed = True
+        websocket.close()
+    
+    def _throttle(self, websocket, throttled):
+        #==================================================================
+        # Called by WebSocket when its sendq goes over the high watermark
+        # or back under the low one. A throttled socket is only polled for
+        # writability, it always has something queued.
+        #==================================================================
+        if self.socks.get(websocket.fileno) is not websocket:
+            return
+        
+        if throttled:
+            if websocket not in self.throttled:
+                self.throttled[websocket] = self._schedule(CHECK_INTERVAL, self._check_throttled,
+                    websocket)
+        else:
+            timer = self.throttled.pop(websocket, None)
+            
+            if timer is not None:
+                timer.cancel()
+        
+        self._update_interest(websocket)
+    
+    def _schedule(self, delay, func, *args):
+        #==================================================================
+        # Call func(*args) from the server loop in delay seconds. Returns a
+        # timer with a cancel() method.
+        #==================================================================
+        return self.timers.schedule(delay, func, *args)
+    
+    def _tls_handshake(self, fileno, websocket):
+        #==================================================================
+        # Take the TLS handshake as far as it will go without blocking and
+        # wait for whichever of READ or WRITE it needs next.
+        #==================================================================
+        try:
+            websocket.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.poller.modify(fileno, READ)
+            return
+        except ssl.SSLWantWriteError:
+            self.poller.modify(fileno, WRITE)
+            return
+        except Exception as ex:
+            sys.stderr.write('%s\n' % str(ex))
+            self._abort(websocket)
+            return
+        
+        self.handshaking.pop(websocket).cancel()
+        websocket._accepted()
+        
+        if self.tls is not None:
+            self.tls.handshaked(websocket.sock)
+        
+        self._update_interest(websocket)
+    
+    def _tls_timeout(self, websocket):
+        if self.handshaking.pop(websocket, None) is None:
+            return
+        
+        sys.stderr.write('error: TLS handshake timed out. Resource #%s\n' % websocket.fileno)
+        self._abort(websocket)
     
     def _write(self, fileno, sock):
+        if sock in self.handshaking:
+            self._tls_handshake(fileno, sock)
+            return
+        
         try:
-            while sock.sendq:
-                opcode, payload = sock.sendq.popleft()
-                remaining = sock._send_buffer(payload)
-                
-                if remaining is not None:
-                    sock.sendq.appendleft((opcode, remaining))
-                    break
-                else:
-                    if opcode == CLOSE:
-                        raise Exception('info: received client close')
+            sock._send_queue()
+            
+            #==============================================================
+            # Everything has been written so stop asking for writability.
+            #==============================================================
+            if not sock.sendq:
+                self._update_interest(sock)
         except Exception as ex:
             sys.stderr.write('%s\n' % str(ex))
             sock.close()
+    
+    def _queued(self, websocket):
+        #==================================================================
+        # Hand websocket's queued handler calls to the pool unless it is
+        # already running some, its calls are made one after another. Stop
+        # reading from it once it has handlerqueue calls waiting.
+        #==================================================================
+        if websocket not in self.running:
+            if self.inflight < self.maxinflight:
+                self._submit(websocket)
+                return
             
-            del self.socks[fileno]
-            self.listeners.remove(fileno)
+            #==============================================================
+            # waitingset saves searching the deque for every call queued
+            # while the pool is full.
+            #==============================================================
+            if websocket not in self.waitingset:
+                self.waitingset.add(websocket)
+                self.waiting.append(websocket)
+        
+        if websocket not in self.paused and len(websocket.inbox) >= websocket.handlerqueue:
+            self.paused.add(websocket)
+            self._update_interest(websocket)
+    
+    def _off_loop(self):
+        return self.executor is not None and threading.current_thread() is not self.loopthread
+    
+    def _update_interest(self, websocket):
+        #==================================================================
+        # Poll for READ unless the client is throttled, closing or we have
+        # stopped reading for its handlers to catch up, and for WRITE while
+        # it has something queued.
+        #==================================================================
+        if self.socks.get(websocket.fileno) is not websocket:
+            return
+        
+        events = WRITE if websocket.sendq else 0
+        
+        if (websocket.closed is False and websocket not in self.throttled
+                and websocket not in self.paused):
+            events |= READ
+        
+        self.poller.modify(websocket.fileno, events)
+    
+    def _want_write(self, websocket):
+        #==================================================================
+        # Called by WebSocket when its sendq goes from empty to non-empty.
+        #==================================================================
+        self._update_interest(websocket)
     
     def _writers(self, socks):
         for fileno in socks:
-            sock = self.socks[fileno]
-            self._write(fileno, sock)
+            sock = self.socks.get(fileno)
+            
+            if sock is not None:
+                self._write(fileno, sock)
     
     def close(self):
         self.master.close()
         
-        for desc, sock in self.socks.items():
+        for sock in list(self.socks.values()):
             sock.close()
+        
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        
+        if self.processpool is not None:
+            self.processpool.shutdown()
+        
+        if self.wakeup_fileno is not None:
+            os.close(self.wakeup_fileno)
+            os.close(self.wakeup_write)
+        
+        self.poller.close()
     
     def run(self):
+        self.loopthread = threading.current_thread()
+        
         while True:
             self._run()
\ No newline at end of file
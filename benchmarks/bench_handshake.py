@@ -0,0 +1,141 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# Upgrade requests parsed per second, the request
+# arriving in one piece and in small pieces.
+#
+# BaseHTTPRequestHandler is how the handshake used
+# to parse it, with a regex compiled each time for
+# the resource and the whole buffer searched for the
+# end of the header on every recv.
+#
+# $ python benchmarks/bench_handshake.py
+#===================================================
+
+from    __future__  import  print_function
+
+import  os
+import  re
+import  sys
+import  timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'WebSocketServer'))
+
+from    handshake   import  find_terminator, has_token, parse_request
+
+if sys.version_info[0] >= 3:
+    from    http.server     import  BaseHTTPRequestHandler
+    from    io              import  BytesIO
+else:
+    from    BaseHTTPServer  import  BaseHTTPRequestHandler
+    from    StringIO        import  StringIO as BytesIO
+
+#==========================================================================
+# Roughly what a browser sends.
+#==========================================================================
+REQUEST = (
+    b'GET /chat?room=lobby HTTP/1.1\r\n'
+    b'Host: example.com:8443\r\n'
+    b'Connection: Upgrade\r\n'
+    b'Pragma: no-cache\r\n'
+    b'Cache-Control: no-cache\r\n'
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    b'Chrome/66.0.3359.117 Safari/537.36\r\n'
+    b'Upgrade: websocket\r\n'
+    b'Origin: https://example.com\r\n'
+    b'Sec-WebSocket-Version: 13\r\n'
+    b'Accept-Encoding: gzip, deflate, br\r\n'
+    b'Accept-Language: en-GB,en;q=0.9\r\n'
+    b'Cookie: session=0123456789abcdef0123456789abcdef\r\n'
+    b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+    b'Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits\r\n'
+    b'\r\n'
+)
+
+class HTTPRequest(BaseHTTPRequestHandler):
+    def __init__(self, request_text):
+        self.rfile = BytesIO(request_text)
+        self.raw_requestline = self.rfile.readline()
+        self.error_code = self.error_message = None
+        self.parse_request()
+
+def _old(chunks):
+    buffer = bytearray()
+    
+    for chunk in chunks:
+        buffer.extend(chunk)
+        
+        if b'\r\n\r\n' in buffer:
+            request = HTTPRequest(buffer)
+            match = re.compile('GET (.*) HTTP').search(buffer.decode('utf-8'))
+            headers = request.headers
+            
+            return (match.group(1), headers['Host'], headers['Upgrade'] == 'websocket',
+                headers['Connection'].find('Upgrade') != -1, headers['Sec-WebSocket-Key'],
+                headers['Sec-WebSocket-Version'] == '13')
+
+def _new(chunks):
+    buffer = bytearray()
+    scanned = 0
+    
+    for chunk in chunks:
+        buffer.extend(chunk)
+        end = find_terminator(buffer, scanned)
+        scanned = len(buffer)
+        
+        if end != -1:
+            method, resource, headers = parse_request(buffer[:end])
+            
+            return (resource, headers['Host'], has_token(headers['Upgrade'], 'websocket'),
+                has_token(headers['Connection'], 'upgrade'), headers['Sec-WebSocket-Key'],
+                headers['Sec-WebSocket-Version'] == '13')
+
+def _rate(func, chunks):
+    number = 1
+    
+    while True:
+        elapsed = timeit.timeit(lambda: func(chunks), number=number)
+        
+        if elapsed >= 0.5:
+            return number / elapsed
+        
+        number *= 2
+
+def main():
+    for label, size in [('one recv', len(REQUEST)), ('64 byte recvs', 64)]:
+        chunks = [REQUEST[i:i + size] for i in range(0, len(REQUEST), size)]
+        
+        if _old(chunks) != _new(chunks):
+            raise SystemExit('error: the parsers disagree')
+        
+        old = _rate(_old, chunks)
+        new = _rate(_new, chunks)
+        
+        print('%s:' % label)
+        print('  %-24s %10.0f requests/s' % ('BaseHTTPRequestHandler', old))
+        print('  %-24s %10.0f requests/s  %.1fx' % ('parse_request', new, new / old))
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,145 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# TLS handshakes per second with a TLSConfig
+# context, full handshakes against resumed ones.
+# Both ends run in this process over memory BIOs so
+# only the handshake itself is measured. A throwaway
+# certificate is made with the openssl command when
+# --cert and --pkey aren't given.
+#
+# $ python benchmarks/bench_tls_handshake.py [--cert cert.pem --pkey privkey.pem]
+#===================================================
+
+from    __future__  import  print_function
+
+import  os
+import  shutil
+import  ssl
+import  subprocess
+import  sys
+import  tempfile
+import  time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'WebSocketServer'))
+
+from    tlsconfig   import  TLSConfig
+
+DURATION = 2.0
+
+def _certificate(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    pkey = os.path.join(directory, 'privkey.pem')
+    
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt',
+        'ec_paramgen_curve:prime256v1', '-nodes', '-subj', '/CN=localhost', '-days', '1',
+        '-keyout', pkey, '-out', cert], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    
+    return cert, pkey
+
+def _handshake(server_context, client_context, session=None):
+    #==============================================================
+    # Pass records between the two ends until both are done, then
+    # let the client read the session tickets TLS 1.3 sends after
+    # the handshake. Returns the client's SSLObject.
+    #==============================================================
+    server_in, server_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+    client_in, client_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+    
+    server = server_context.wrap_bio(server_in, server_out, server_side=True)
+    client = client_context.wrap_bio(client_in, client_out, session=session)
+    
+    done = [False, False]
+    
+    while not all(done):
+        for index, end in enumerate((client, server)):
+            if done[index]:
+                continue
+            
+            try:
+                end.do_handshake()
+                done[index] = True
+            except ssl.SSLWantReadError:
+                pass
+        
+        server_in.write(client_out.read())
+        client_in.write(server_out.read())
+    
+    try:
+        client.read(1)
+    except ssl.SSLWantReadError:
+        pass
+    
+    return client
+
+def _rate(server_context, client_context, resume):
+    session = _handshake(server_context, client_context).session if resume else None
+    count = 0
+    resumed = 0
+    start = time.time()
+    
+    while time.time() - start < DURATION:
+        client = _handshake(server_context, client_context, session)
+        count += 1
+        
+        if client.session_reused:
+            resumed += 1
+    
+    return count / (time.time() - start), resumed, count
+
+def main():
+    directory = None
+    
+    if '--cert' in sys.argv and '--pkey' in sys.argv:
+        cert = sys.argv[sys.argv.index('--cert') + 1]
+        pkey = sys.argv[sys.argv.index('--pkey') + 1]
+    else:
+        directory = tempfile.mkdtemp()
+        cert, pkey = _certificate(directory)
+    
+    try:
+        server_context = TLSConfig(cert, pkey, rotation=0).context
+        
+        for label, version in [('TLS 1.2', ssl.TLSVersion.TLSv1_2), ('TLS 1.3', ssl.TLSVersion.TLSv1_3)]:
+            client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            client_context.check_hostname = False
+            client_context.verify_mode = ssl.CERT_NONE
+            client_context.minimum_version = version
+            client_context.maximum_version = version
+            
+            print('%s:' % label)
+            
+            full, _, _ = _rate(server_context, client_context, False)
+            print('  %-8s %10.0f handshakes/s' % ('full', full))
+            
+            rate, resumed, count = _rate(server_context, client_context, True)
+            print('  %-8s %10.0f handshakes/s  %.1fx  (%s of %s resumed)'
+                % ('resumed', rate, rate / full, resumed, count))
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,90 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# Compare the payload unmasking routines.
+#
+# $ python benchmarks/bench_unmask.py
+#===================================================
+
+from    __future__  import  print_function
+
+import  os
+import  sys
+import  timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'WebSocketServer'))
+
+import  masking
+
+SIZES = [
+    ('125 B', 125),
+    ('64 KiB', 65536),
+    ('16 MiB', 16777216),
+]
+
+def _time(func, data, mask):
+    #==============================================================
+    # Aim for roughly a quarter of a second per measurement.
+    #==============================================================
+    number = 1
+    
+    while True:
+        elapsed = timeit.timeit(lambda: func(data, mask), number=number)
+        
+        if elapsed >= 0.25 or number >= 1000000:
+            return elapsed / number
+        
+        number *= 10
+
+def main():
+    mask = bytearray(os.urandom(4))
+    routines = [('bytes', masking.unmask_bytes), ('int', masking.unmask_int)]
+    
+    if masking.unmask_numpy is not None:
+        routines.append(('numpy', masking.unmask_numpy))
+    
+    routines.append(('unmask', masking.unmask))
+    
+    for label, size in SIZES:
+        data = os.urandom(size)
+        expected = masking.unmask_bytes(data, mask)
+        baseline = None
+        
+        print('%s:' % label)
+        
+        for name, func in routines:
+            if func(data, mask) != expected:
+                raise SystemExit('error: %s produced the wrong output' % name)
+            
+            elapsed = _time(func, data, mask)
+            
+            if baseline is None:
+                baseline = elapsed
+            
+            print('    %-8s %12.2f us  %10.1f MB/s  %8.1fx' % (name, elapsed * 1e6,
+                size / elapsed / 1e6, baseline / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# TimerWheel tests on a clock that only moves when
+# told to. The wheels are small so timers cascade
+# down several levels and run past the top one.
+#
+# $ python -m unittest discover tests
+#===================================================
+
+import  os
+import  sys
+import  unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from    WebSocketServer     import  timerwheel
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.monotonic = timerwheel.monotonic
+        timerwheel.monotonic = self.clock
+        
+        #==================================================================
+        # Levels of 4, 16 and 64 ticks of a second each.
+        #==================================================================
+        self.wheel = timerwheel.TimerWheel(resolution=1.0, slots=4, levels=3)
+        self.fired = []
+    
+    def tearDown(self):
+        timerwheel.monotonic = self.monotonic
+    
+    def _fire(self, name):
+        self.fired.append((name, self.clock.now - 1000.0))
+    
+    def _run(self, seconds, step=1.0):
+        end = self.clock.now + seconds
+        
+        while self.clock.now < end:
+            self.clock.now = min(self.clock.now + step, end)
+            self.wheel.advance()
+    
+    def test_fire_on_time_across_levels(self):
+        #==================================================================
+        # Delays in each level and on the boundaries between them.
+        #==================================================================
+        delays = [1, 2, 3, 4, 5, 15, 16, 17, 31, 63]
+        
+        for delay in delays:
+            self.wheel.schedule(delay, self._fire, delay)
+        
+        self._run(70)
+        
+        self.assertEqual(self.fired, [(delay, float(delay)) for delay in delays])
+        self.assertEqual(self.wheel.count, 0)
+        self.assertIsNone(self.wheel.timeout())
+    
+    def test_one_large_advance(self):
+        #==================================================================
+        # A late advance runs everything that is due, in order.
+        #==================================================================
+        for delay in [40, 3, 17, 9]:
+            self.wheel.schedule(delay, self._fire, delay)
+        
+        self._run(20, step=20)
+        
+        self.assertEqual([name for name, when in self.fired], [3, 9, 17])
+        
+        self._run(30, step=30)
+        
+        self.assertEqual([name for name, when in self.fired], [3, 9, 17, 40])
+    
+    def test_fractional_delay_never_early(self):
+        self.clock.now += 0.25
+        self.wheel.schedule(2.5, self._fire, 'late')
+        self._run(2.25, step=0.25)
+        
+        self.assertEqual(self.fired, [])
+        
+        self._run(1.0, step=0.25)
+        
+        self.assertEqual(len(self.fired), 1)
+        self.assertTrue(2.75 <= self.fired[0][1] <= 3.75)
+    
+    def test_cancel(self):
+        near = self.wheel.schedule(2, self._fire, 'near')
+        far = self.wheel.schedule(20, self._fire, 'far')
+        cascaded = self.wheel.schedule(30, self._fire, 'cascaded')
+        self.wheel.schedule(25, self._fire, 'kept')
+        
+        near.cancel()
+        far.cancel()
+        
+        #==================================================================
+        # Cancelling twice is harmless.
+        #==================================================================
+        far.cancel()
+        
+        self.assertEqual(self.wheel.count, 2)
+        
+        #==================================================================
+        # By now cascaded has been moved down a level.
+        #==================================================================
+        self._run(28)
+        cascaded.cancel()
+        
+        self.assertEqual(self.wheel.count, 0)
+        
+        self._run(40)
+        
+        self.assertEqual(self.fired, [('kept', 25.0)])
+        self.assertIsNone(self.wheel.timeout())
+    
+    def test_past_the_top_level(self):
+        #==================================================================
+        # The top level reaches 64 ticks, these wait in its furthest slot
+        # and are placed again when it comes round.
+        #==================================================================
+        for delay in [64, 100, 200, 1000]:
+            self.wheel.schedule(delay, self._fire, delay)
+        
+        self._run(1100)
+        
+        self.assertEqual(self.fired, [(64, 64.0), (100, 100.0), (200, 200.0), (1000, 1000.0)])
+    
+    def test_schedule_from_a_timer(self):
+        def again(count):
+            self._fire(count)
+            
+            if count < 5:
+                self.wheel.schedule(7, again, count + 1)
+        
+        self.wheel.schedule(7, again, 1)
+        self._run(50)
+        
+        self.assertEqual(self.fired, [(count, count * 7.0) for count in range(1, 6)])
+    
+    def test_timeout(self):
+        self.assertIsNone(self.wheel.timeout())
+        
+        self.wheel.schedule(3, self._fire, 'a')
+        self.assertEqual(self.wheel.timeout(), 3.0)
+        
+        self.clock.now += 1.5
+        self.assertEqual(self.wheel.timeout(), 1.5)
+        
+        #==================================================================
+        # Never more than the time to the next level to move down.
+        #==================================================================
+        self.wheel.schedule(50, self._fire, 'b')
+        self.assertTrue(self.wheel.timeout() <= 1.5)
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,378 @@
+#-------------------------------------------------------------------------------------
+#
+#   Copyright 2018 Robert Pengelly.
+#
+#   This file is part of WebSocketServer.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------------
+
+#!/usr/bin/env python
+# coding: utf-8
+
+#===================================================
+# WebSocket tests run against a fake socket, no
+# server is started.
+#
+# $ python -m unittest discover tests
+#===================================================
+
+import  errno
+import  mmap
+import  os
+import  socket
+import  struct
+import  sys
+import  tempfile
+import  unittest
+import  zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from    WebSocketServer.permessagedeflate   import  PerMessageDeflate
+from    WebSocketServer.websocket           import  BINARY, CLOSE, DROP, STREAM, WebSocket, _FileSegment
+
+class FakeSocket(object):
+    #======================================================================
+    # Takes nothing while blocked, as a client that has stopped reading.
+    #======================================================================
+    def __init__(self):
+        self.blocked = True
+        self.closed = False
+        self.data = bytearray()
+    
+    def close(self):
+        self.closed = True
+    
+    def fileno(self):
+        return 99
+    
+    def send(self, data):
+        if self.blocked:
+            raise socket.error(errno.EAGAIN, 'would block')
+        
+        self.data.extend(data)
+        
+        return len(data)
+
+def _frame(b1, payload):
+    #======================================================================
+    # A masked frame as a client sends it.
+    #======================================================================
+    mask = os.urandom(4)
+    length = len(payload)
+    
+    if length < 126:
+        header = struct.pack('!BB', b1, 0x80 | length)
+    elif length < 65536:
+        header = struct.pack('!BBH', b1, 0x80 | 126, length)
+    else:
+        header = struct.pack('!BBQ', b1, 0x80 | 127, length)
+    
+    masked = bytearray(payload)
+    
+    for i in range(length):
+        masked[i] ^= bytearray(mask)[i % 4]
+    
+    return header + mask + bytes(masked)
+
+def _read_frames(data):
+    frames = []
+    pos = 0
+    
+    while pos < len(data):
+        b1, b2 = struct.unpack_from('!BB', data, pos)
+        length = b2 & 0x7F
+        pos += 2
+        
+        if length == 126:
+            length = struct.unpack_from('!H', data, pos)[0]
+            pos += 2
+        elif length == 127:
+            length = struct.unpack_from('!Q', data, pos)[0]
+            pos += 8
+        
+        frames.append((b1, bytes(data[pos:pos + length])))
+        pos += length
+    
+    return frames
+
+class Received(WebSocket):
+    def handle_message(self):
+        self.received.append(self.data)
+
+def _connect():
+    sock = FakeSocket()
+    sock.blocked = False
+    websocket = Received(None, sock, ('127.0.0.1', 0))
+    websocket.handshaked = True
+    websocket.received = []
+    
+    return websocket, sock
+
+class ParserTest(unittest.TestCase):
+    #======================================================================
+    # Payload lengths that need the 7, 16 and 64 bit length fields.
+    #======================================================================
+    LENGTHS = [0, 1, 125, 126, 65535, 65536, 70000]
+    
+    def _receive(self, chunks):
+        websocket, sock = _connect()
+        
+        for chunk in chunks:
+            websocket._parse_message(bytearray(chunk))
+        
+        return websocket.received
+    
+    def test_lengths(self):
+        for length in self.LENGTHS:
+            payload = os.urandom(length)
+            
+            self.assertEqual(self._receive([_frame(0x80 | BINARY, payload)]), [bytearray(payload)])
+    
+    def test_header_split_at_every_offset(self):
+        #==================================================================
+        # Every split of the header, and just past it, across two recvs.
+        #==================================================================
+        for length in self.LENGTHS:
+            payload = os.urandom(length)
+            data = _frame(0x80 | BINARY, payload)
+            
+            for split in range(1, min(len(data), 16)):
+                self.assertEqual(self._receive([data[:split], data[split:]]), [bytearray(payload)],
+                    'length %s split at %s' % (length, split))
+    
+    def test_one_byte_at_a_time(self):
+        payload = u'h\xe9llo'.encode('utf-8') * 40
+        data = _frame(0x80 | 0x01, payload)
+        
+        self.assertEqual(self._receive([data[i:i + 1] for i in range(len(data))]),
+            [payload.decode('utf-8')])
+    
+    def test_several_frames_in_one_buffer(self):
+        payloads = [os.urandom(length) for length in self.LENGTHS]
+        data = b''.join(_frame(0x80 | BINARY, payload) for payload in payloads)
+        expected = [bytearray(payload) for payload in payloads]
+        
+        self.assertEqual(self._receive([data]), expected)
+        
+        #==================================================================
+        # And with the frames straddling recvs of an awkward size.
+        #==================================================================
+        self.assertEqual(self._receive([data[i:i + 1000] for i in range(0, len(data), 1000)]),
+            expected)
+    
+    def test_fragments_and_control_frames_in_one_buffer(self):
+        websocket, sock = _connect()
+        data = (_frame(BINARY, b'ab') + _frame(0x80 | 0x09, b'ping') + _frame(0x80 | STREAM, b'cd')
+            + _frame(0x80 | BINARY, b'ef'))
+        
+        websocket._parse_message(bytearray(data))
+        
+        websocket._send_queue()
+        
+        self.assertEqual(websocket.received, [bytearray(b'abcd'), bytearray(b'ef')])
+        self.assertEqual(_read_frames(sock.data), [(0x80 | 0x0A, b'ping')])
+
+class SendFileTest(unittest.TestCase):
+    def test_range_past_end_of_file(self):
+        websocket, sock = _connect()
+        
+        with tempfile.TemporaryFile() as file:
+            file.write(b'x' * 100)
+            file.flush()
+            
+            for offset, count in [(0, 101), (50, 51), (101, None), (-1, 10), (0, -1)]:
+                with self.assertRaises(ValueError):
+                    websocket.send_file(file, offset, count)
+            
+            self.assertEqual(len(websocket.sendq), 0)
+            
+            websocket.send_file(file, 50, 50)
+            websocket.send_file(file, 100)
+        
+        websocket._send_queue()
+        
+        self.assertEqual(_read_frames(sock.data), [(0x80 | BINARY, b'x' * 50), (0x80 | BINARY, b'')])
+    
+    def test_after_close(self):
+        #==================================================================
+        # A handler can still run once the client has gone, the file must
+        # not be left open in a sendq nothing will send or close.
+        #==================================================================
+        websocket, sock = _connect()
+        websocket.close()
+        
+        with tempfile.TemporaryFile() as file:
+            file.write(b'x' * 100)
+            file.flush()
+            
+            before = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+            
+            for i in range(10):
+                self.assertFalse(websocket.send_file(file))
+            
+            self.assertEqual(len(websocket.sendq), 0)
+            
+            #==============================================================
+            # Queued from a thread before the close reached the loop.
+            #==============================================================
+            fd = os.dup(file.fileno())
+            websocket._queue(BINARY, _FileSegment(fd, 0, 100))
+            
+            self.assertEqual(len(websocket.sendq), 0)
+            self.assertRaises(OSError, os.fstat, fd)
+            
+            if before is not None:
+                self.assertEqual(len(os.listdir('/proc/self/fd')), before)
+
+class MessageSizeTest(unittest.TestCase):
+    def test_fragments_over_maxpayload_close_with_1009(self):
+        websocket, sock = _connect()
+        websocket.maxpayload = 60000
+        websocket.spillthreshold = 32768
+        chunk = os.urandom(16384)
+        
+        websocket._parse_message(_frame(BINARY, chunk))
+        
+        for i in range(2):
+            websocket._parse_message(_frame(STREAM, chunk))
+        
+        self.assertFalse(websocket.closed)
+        self.assertIsNotNone(websocket.spill)
+        
+        with self.assertRaises(Exception):
+            websocket._parse_message(_frame(STREAM, chunk))
+        
+        self.assertTrue(websocket.closed)
+        self.assertIsNone(websocket.spill)
+        self.assertEqual(websocket.received, [])
+        self.assertEqual(_read_frames(sock.data), [(0x80 | CLOSE, struct.pack('!H', 1009)
+            + b'message too big')])
+    
+    def test_fragments_up_to_maxpayload(self):
+        websocket, sock = _connect()
+        websocket.maxpayload = 65536
+        websocket.spillthreshold = None
+        chunk = os.urandom(16384)
+        
+        websocket._parse_message(_frame(BINARY, chunk))
+        
+        for i in range(2):
+            websocket._parse_message(_frame(STREAM, chunk))
+        
+        websocket._parse_message(_frame(0x80 | STREAM, chunk))
+        
+        self.assertFalse(websocket.closed)
+        self.assertEqual(websocket.received, [bytearray(chunk * 4)])
+
+class SpillTest(unittest.TestCase):
+    def _receive(self, frames):
+        websocket, sock = _connect()
+        websocket.deflate = PerMessageDeflate()
+        websocket.spillthreshold = 65536
+        
+        for frame in frames:
+            websocket._parse_message(frame)
+        
+        return websocket.received
+    
+    def test_compressed_message_is_spilled(self):
+        #==================================================================
+        # Whether or not it was fragmented.
+        #==================================================================
+        message = os.urandom(16384) * 8
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        payload = compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        payload = payload[:-4]
+        half = len(payload) // 2
+        
+        single = self._receive([_frame(0x80 | 0x40 | BINARY, payload)])
+        fragmented = self._receive([_frame(0x40 | BINARY, payload[:half]),
+            _frame(0x80 | STREAM, payload[half:])])
+        
+        for received in [single, fragmented]:
+            self.assertEqual(len(received), 1)
+            self.assertIsInstance(received[0], mmap.mmap)
+            self.assertEqual(received[0][:], message)
+
+class SlowConsumerTest(unittest.TestCase):
+    def _flood(self, deflate):
+        sock = FakeSocket()
+        websocket = WebSocket(None, sock, ('127.0.0.1', 0))
+        websocket.handshaked = True
+        websocket.deflate = deflate
+        websocket.deflatethreshold = 0
+        websocket.sendqhigh = 1024
+        websocket.sendqlow = 0
+        websocket.slowconsumer = DROP
+        websocket.slowtimeout = 0
+        
+        #==================================================================
+        # Messages that share most of their bytes, so with context
+        # takeover each one refers back to the one before.
+        #==================================================================
+        shared = os.urandom(2048)
+        messages = [('message %d ' % i).encode('ascii') + shared for i in range(16)]
+        
+        for message in messages:
+            websocket.send_message(message)
+        
+        self.assertTrue(websocket.throttled)
+        
+        return websocket, sock, messages
+    
+    def test_drop_without_context_takeover(self):
+        websocket, sock, messages = self._flood(PerMessageDeflate(server_no_context_takeover=True))
+        websocket._check_slow_consumer()
+        
+        self.assertFalse(websocket.closed)
+        self.assertEqual(len(websocket.sendq), 1)
+        
+        sock.blocked = False
+        websocket._send_queue()
+        
+        #==================================================================
+        # What is left must still inflate with the client's context.
+        #==================================================================
+        inflater = zlib.decompressobj(-15)
+        frames = _read_frames(sock.data)
+        
+        self.assertEqual(len(frames), 1)
+        
+        for b1, payload in frames:
+            self.assertEqual(b1 & 0x0F, BINARY)
+            self.assertEqual(b1 & 0x40, 0x40)
+            self.assertIn(inflater.decompress(payload + b'\x00\x00\xff\xff'), messages)
+    
+    def test_drop_with_context_takeover_disconnects(self):
+        websocket, sock, messages = self._flood(PerMessageDeflate())
+        queued = len(websocket.sendq)
+        websocket._check_slow_consumer()
+        
+        self.assertTrue(websocket.closed)
+        self.assertTrue(sock.closed)
+        self.assertEqual(len(websocket.sendq), queued + 1)
+    
+    def test_drop_without_deflate(self):
+        websocket, sock, messages = self._flood(None)
+        websocket._check_slow_consumer()
+        
+        self.assertFalse(websocket.closed)
+        self.assertEqual(len(websocket.sendq), 1)
+        self.assertEqual(websocket.sendqsize, len(websocket.sendq[0][1]))
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file